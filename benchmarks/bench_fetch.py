@@ -0,0 +1,105 @@
+"""
+Offline load test of the fetch path against the stub provider.
+
+    python benchmarks/bench_fetch.py --symbols 10000 --workers 16 --latency 0.05
+    python benchmarks/bench_fetch.py --symbols 10000 --workers 256 --async
+"""
+import argparse
+import asyncio
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# run as a script the repo root is not on the path, only benchmarks/ is
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from secmaster.data_manager.tda_eod import fetch_many, get_tda_prices
+from secmaster.providers.rate_limit import AdaptiveRateLimiter, ThrottledError
+from secmaster.providers.stub import StubProvider
+
+
+def fetch_one(provider, limiter, symbol):
+    # throttled requests are retried, the limiter decides when
+    while True:
+        try:
+            response = get_tda_prices(provider, symbol, limiter=limiter)
+            return "ok", len(response["candles"])
+        except ThrottledError:
+            continue
+        except Exception as e:
+            return type(e).__name__, 0
+
+
+def run_threads(provider, limiter, symbols, workers):
+    outcomes = Counter()
+    candles = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for outcome, n in pool.map(lambda x: fetch_one(provider, limiter, x), symbols):
+            outcomes[outcome] += 1
+            candles += n
+    return outcomes, candles
+
+
+async def run_async(provider, limiter, symbols, workers):
+    outcomes = Counter()
+    candles = 0
+    async with provider:
+        jobs = [(x, None, None) for x in symbols]
+        async for _, response in fetch_many(provider, jobs, workers, limiter):
+            if isinstance(response, Exception):
+                outcomes[type(response).__name__] += 1
+            else:
+                outcomes["ok"] += 1
+                candles += len(response["candles"])
+    return outcomes, candles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--symbols", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--nan-rate", type=float, default=0.001)
+    parser.add_argument("--max-rps", type=int, default=None)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true", help="workers are coroutines"
+    )
+    args = parser.parse_args()
+
+    provider = StubProvider(
+        latency=args.latency,
+        latency_jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        nan_rate=args.nan_rate,
+        max_rps=args.max_rps,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    limiter = AdaptiveRateLimiter(provider.name, max_concurrency=args.workers)
+    symbols = [f"S{i:05d}" for i in range(args.symbols)]
+
+    start = time.perf_counter()
+    if args.use_async:
+        outcomes, candles = asyncio.run(
+            run_async(provider, limiter, symbols, args.workers)
+        )
+    else:
+        outcomes, candles = run_threads(provider, limiter, symbols, args.workers)
+    elapsed = time.perf_counter() - start
+
+    print(f"symbols: {len(symbols)}  calls: {provider.calls}  candles: {candles}")
+    print(f"outcomes: {dict(outcomes)}")
+    print(f"limiter: {limiter.stats()}")
+    print(f"elapsed: {elapsed:.2f}s  ({len(symbols) / elapsed:.1f} symbols/s)")
+
+
+if __name__ == "__main__":
+    main()
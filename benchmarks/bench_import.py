@@ -0,0 +1,107 @@
+"""
+Import time of the secmaster modules, each in a fresh interpreter.
+
+Reports the cumulative import time from `python -X importtime` and which heavy
+third party modules came along. Modules over their budget, or pulling a heavy
+module they should load lazily, are flagged and make the run exit with 1.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --repeat 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# the probes run from the repo root, so secmaster imports from any directory
+ROOT = Path(__file__).resolve().parents[1]
+
+# Heavy modules no entry point should import before it needs them
+HEAVY = ["pandas", "numpy", "holidays", "pytz", "yfinance", "tda", "httpx", "pyarrow"]
+
+# Import budget in ms. Modules touching the database pay for SQLAlchemy.
+BUDGETS = {
+    "secmaster.cli": 50,
+    "secmaster.common.config": 30,
+    "secmaster.providers.base": 30,
+    "secmaster.providers.rate_limit": 50,
+    "secmaster.data_manager.update_symbols_info": 600,
+    "secmaster.data_manager.nasdaq_symbols": 600,
+    "secmaster.data_manager.tda_eod": 700,
+    "secmaster.service.server": 700,
+}
+
+PROBE = """
+import sys
+import {module}
+print("HEAVY", *[x for x in {heavy!r} if x in sys.modules])
+"""
+
+
+def import_time(module):
+    """
+    :param module: dotted module name
+    :return: (cumulative import time in ms, list of heavy modules loaded)
+    """
+    probe = PROBE.format(module=module, heavy=HEAVY)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", probe],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+
+    cumulative = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            cumulative = int(parts[1])
+    heavy = result.stdout.split()[1:]
+    return cumulative / 1000, heavy
+
+
+def startup_time(argv, repeat):
+    """
+    :return: median wall time in ms of running a command
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, capture_output=True, cwd=ROOT)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per module")
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS))
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':45} {'ms':>8} {'budget':>8}  heavy imports")
+    for module in args.modules:
+        budget = BUDGETS.get(module)
+        runs = [import_time(module) for _ in range(args.repeat)]
+        ms = statistics.median(x[0] for x in runs)
+        heavy = runs[0][1]
+        over = budget is not None and ms > budget
+        failed = failed or over or bool(heavy)
+        flag = " <-- over budget" if over else ""
+        print(
+            f"{module:45} {ms:8.1f} {budget or '-':>8}  {' '.join(heavy) or '-'}{flag}"
+        )
+
+    baseline = startup_time([sys.executable, "-c", "pass"], args.repeat)
+    cli = startup_time([sys.executable, "-m", "secmaster", "--help"], args.repeat)
+    print(f"\ninterpreter startup {baseline:.1f} ms, `secmaster --help` {cli:.1f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
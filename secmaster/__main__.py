@@ -0,0 +1,5 @@
+import sys
+
+from secmaster.cli import main
+
+sys.exit(main())
@@ -0,0 +1,386 @@
+"""
+secmaster command line.
+
+Every command imports what it needs when it runs, so `--help` and `query`
+start without SQLAlchemy, pandas or the provider clients. `query` asks the
+running price service (`secmaster serve`) instead of opening the database.
+
+    # the nightly job: symbols, then info and eod at the same time, then
+    # the earnings calendar of the equities info found
+    python -m secmaster update --exclude CEI DCTH --workers 32
+    python -m secmaster update --universe SP500 --since 2015-01-01 --dry-run
+
+    # one stage on its own
+    python -m secmaster symbols --no-download
+    python -m secmaster eod --symbols AAPL MSFT --until 2022-04-22
+    python -m secmaster earnings --universe SP500 --workers 8
+    python -m secmaster backfill --shards 8
+    python -m secmaster serve --port 8050
+    python -m secmaster query bars AAPL MSFT --from 2022-01-01
+    python -m secmaster query snapshot
+    python -m secmaster query changes --after 1200
+
+    # bars held by validation, and the override once reviewed
+    python -m secmaster quarantine --symbols AAPL
+    python -m secmaster quarantine --release 811 812
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGES = ["symbols", "info", "eod", "earnings"]
+
+
+def _date(value):
+    return datetime.datetime.fromisoformat(value)
+
+
+def _session():
+    from secmaster.common.tools import DatabaseConnector
+
+    return DatabaseConnector().session()
+
+
+def select_symbols(args):
+    """
+    :return: list of strings with the symbols asked for, None for all of them
+    """
+    from secmaster.data_manager.jobs import universe_symbols
+
+    if not args.symbols and not args.universe:
+        return None
+    ans = list(args.symbols or [])
+    for name in args.universe or []:
+        ans.extend(universe_symbols(name))
+    return sorted(set(ans))
+
+
+def build_stages(args):
+    """
+    The nightly graph: new symbols first, then info lookups and bars together.
+    Earnings wait for info, it tells which symbols are equities.
+    """
+    from secmaster.data_manager.jobs import Stage
+
+    symbols = select_symbols(args)
+
+    def run_symbols():
+        from secmaster.data_manager.nasdaq_symbols import update_nasdaq_symbols
+
+        s = _session()
+        try:
+            return update_nasdaq_symbols(s, download=args.download)
+        finally:
+            s.close()
+
+    def plan_symbols():
+        from secmaster.data_manager.nasdaq_symbols import FILES
+
+        source = "download" if args.download else "read the downloaded"
+        return f"{source} {len(FILES)} NASDAQ files and add the new symbols"
+
+    def run_info():
+        from secmaster.data_manager.update_symbols_info import update_symbols_info
+        from secmaster.providers.base import get_provider
+
+        s = _session()
+        try:
+            provider = get_provider(args.provider)
+            return update_symbols_info(s, provider, symbols, args.workers)
+        finally:
+            s.close()
+
+    def plan_info():
+        from secmaster.data_manager.update_symbols_info import get_symbols_without_info
+
+        s = _session()
+        try:
+            n = len(get_symbols_without_info(s, symbols))
+        finally:
+            s.close()
+        return f"look up info of {n} symbols"
+
+    def run_eod():
+        from secmaster.data_manager.tda_eod import update_market_data
+        from secmaster.providers.base import get_provider
+
+        s = _session()
+        try:
+            return update_market_data(
+                s,
+                get_provider(args.provider),
+                args.exclude,
+                args.until,
+                symbols,
+                args.since,
+                args.workers,
+            )
+        finally:
+            s.close()
+
+    def plan_eod():
+        from secmaster.data_manager.tda_eod import get_market_data_jobs
+
+        s = _session()
+        try:
+            jobs = get_market_data_jobs(
+                s, args.exclude, args.until, symbols, args.since
+            )
+        finally:
+            s.close()
+        if not jobs:
+            return "all bars up to date"
+        full = sum(1 for x in jobs if x[1] is None)
+        starts = [x[1] for x in jobs if x[1] is not None]
+        ans = f"fetch bars of {len(jobs)} symbols up to {jobs[0][2]}"
+        if starts:
+            ans += f", from {min(starts)} at the earliest"
+        if full:
+            ans += f", {full} of them their whole history"
+        return ans
+
+    def run_earnings():
+        from secmaster.data_manager.earnings import update_earnings
+        from secmaster.providers.base import get_provider
+
+        s = _session()
+        try:
+            provider = get_provider(args.provider)
+            return update_earnings(s, provider, symbols, args.workers)
+        finally:
+            s.close()
+
+    def plan_earnings():
+        from secmaster.data_manager.earnings import get_symbols_for_earnings
+
+        s = _session()
+        try:
+            n = len(get_symbols_for_earnings(s, symbols))
+        finally:
+            s.close()
+        return f"load earnings dates of {n} equity symbols"
+
+    return [
+        Stage("symbols", run_symbols, plan=plan_symbols),
+        Stage("info", run_info, after=["symbols"], plan=plan_info),
+        Stage("eod", run_eod, after=["symbols"], plan=plan_eod),
+        Stage("earnings", run_earnings, after=["info"], plan=plan_earnings),
+    ]
+
+
+def cmd_update(args):
+    from secmaster.data_manager.jobs import run_stages
+
+    stages = [x for x in build_stages(args) if x.name in args.stages]
+    results = run_stages(stages, dry_run=args.dry_run)
+    for name, result in results.items():
+        logger.info(f"{name}: {result}")
+    failed = [x for x, r in results.items() if r["status"] in ("failed", "skipped")]
+    return 1 if failed else 0
+
+
+def cmd_backfill(args):
+    from secmaster.data_manager.backfill import backfill
+
+    report = backfill(args.shards, args.provider, args.exclude, args.rate)
+    return 1 if report["failed_shards"] else 0
+
+
+def cmd_quarantine(args):
+    from secmaster.data_manager.validation import get_quarantined, release_quarantined
+    from secmaster.db.symbol_ids import get_symbol_dictionary
+
+    s = _session()
+    try:
+        if args.release:
+            release_quarantined(s, args.release)
+            return 0
+        dictionary = get_symbol_dictionary()
+        ids = None
+        if args.symbols:
+            ids = list(dictionary.ids(args.symbols, s).values())
+        rows = get_quarantined(s, ids)
+        symbols = dictionary.symbols({x["symbol_id"] for x in rows}, s)
+    finally:
+        s.close()
+
+    columns = ["id", "symbol", "date", "open", "high", "low", "close", "volume"]
+    print("\t".join(columns + ["reasons"]))
+    for row in rows:
+        row["symbol"] = symbols.get(row["symbol_id"])
+        values = [row[x] for x in columns + ["reasons"]]
+        print("\t".join("" if x is None else str(x) for x in values))
+
+
+def cmd_serve(args):
+    from secmaster.service.server import PriceQueryServer
+
+    server = PriceQueryServer((args.host, args.port), pool_size=args.pool_size)
+    logger.info(f"Serving prices on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def fetch_columns(url, path, params):
+    """
+    Query the price service, JSON format
+
+    :param url: service base url
+    :param path: /bars, /snapshot or /universe
+    :param params: dict of query parameters, None values left out
+    :return: iterator of dicts of columns, one per batch
+    """
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode, urlparse
+
+    params = {k: v for k, v in params.items() if v is not None}
+    params["format"] = "json"
+    target = urlparse(url)
+    connection = HTTPConnection(target.hostname, target.port or 80, timeout=60)
+    try:
+        connection.request("GET", f"{path}?{urlencode(params)}")
+        response = connection.getresponse()
+    except OSError as e:
+        logger.error(
+            f"Price service not reachable at {url}: {e}. "
+            f"Start it with `python -m secmaster serve`"
+        )
+        raise SystemExit(1)
+
+    try:
+        if response.status != 200:
+            message = json.loads(response.read() or b"{}").get("error")
+            logger.error(f"Price service answered {response.status}: {message}")
+            raise SystemExit(1)
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        connection.close()
+
+
+def cmd_query(args):
+    from secmaster.common.config import Config
+
+    params = {}
+    if args.what == "bars":
+        if not args.symbols:
+            logger.error("query bars needs at least one symbol")
+            raise SystemExit(1)
+        params["symbol"] = ",".join(args.symbols)
+        params["from"] = args.date_from
+        params["to"] = args.date_to
+    elif args.what == "snapshot":
+        params["date"] = args.date
+    elif args.what == "changes":
+        params["after"] = args.after
+    elif args.active:
+        params["active"] = "1"
+
+    url = args.url or Config.PRICE_SERVICE_URL
+    header = None
+    for batch in fetch_columns(url, f"/{args.what}", params):
+        if header is None:
+            header = list(batch)
+            print("\t".join(header))
+        for row in zip(*[batch[x] for x in header]):
+            print("\t".join("" if x is None else str(x) for x in row))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="secmaster", description="Security master")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    stage = argparse.ArgumentParser(add_help=False)
+    stage.add_argument("--symbols", nargs="*", default=None, help="only these")
+    stage.add_argument(
+        "--universe",
+        nargs="*",
+        default=None,
+        metavar="INDEX",
+        help="only the constituents of these indices, like SP500 NASDAQ100",
+    )
+    stage.add_argument("--since", type=_date, default=None, help="fetch no bars older")
+    stage.add_argument("--until", type=_date, default=None, help="default last session")
+    stage.add_argument("--workers", type=int, default=16, help="requests in flight")
+    stage.add_argument("--dry-run", action="store_true", help="only show the plan")
+    stage.add_argument("--provider", default=None)
+    stage.add_argument("--exclude", nargs="*", default=[], help="symbols not to update")
+    stage.add_argument(
+        "--no-download",
+        dest="download",
+        action="store_false",
+        help="use the NASDAQ files already downloaded",
+    )
+
+    p = commands.add_parser(
+        "update",
+        parents=[stage],
+        help="symbols, then info and bars concurrently, then earnings",
+    )
+    p.add_argument("--stages", nargs="*", default=STAGES, choices=STAGES)
+    p.set_defaults(func=cmd_update)
+
+    for name, text in [
+        ("symbols", "update symbols from the NASDAQ files"),
+        ("info", "fill sector and industry of new symbols"),
+        ("eod", "fetch the missing daily bars"),
+        ("earnings", "load the earnings calendar of equity symbols"),
+    ]:
+        p = commands.add_parser(name, parents=[stage], help=text)
+        p.set_defaults(func=cmd_update, stages=[name])
+
+    p = commands.add_parser("backfill", help="sharded backfill, one process a shard")
+    p.add_argument("--shards", type=int, default=os.cpu_count())
+    p.add_argument("--provider", default=None)
+    p.add_argument("--rate", type=float, default=20.0, help="requests/s, all shards")
+    p.add_argument("--exclude", nargs="*", default=[], help="symbols not to update")
+    p.set_defaults(func=cmd_backfill)
+
+    p = commands.add_parser("quarantine", help="list held bars, or release them")
+    p.add_argument("--symbols", nargs="*", default=None, help="only these")
+    p.add_argument(
+        "--release",
+        nargs="+",
+        type=int,
+        default=None,
+        metavar="ID",
+        help="write these reviewed bars to bars, replacing the stored ones",
+    )
+    p.set_defaults(func=cmd_quarantine)
+
+    p = commands.add_parser("serve", help="run the read-only price service")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8050)
+    p.add_argument("--pool-size", type=int, default=8)
+    p.set_defaults(func=cmd_serve)
+
+    p = commands.add_parser("query", help="ask the price service, tab separated")
+    p.add_argument("what", choices=["bars", "snapshot", "universe", "changes"])
+    p.add_argument("symbols", nargs="*")
+    p.add_argument("--from", dest="date_from", default=None)
+    p.add_argument("--to", dest="date_to", default=None)
+    p.add_argument("--date", default=None, help="snapshot of a past session")
+    p.add_argument("--active", action="store_true", help="only symbols to update")
+    p.add_argument("--after", type=int, default=0, help="changes after this seq")
+    p.add_argument("--url", default=None, help="default Config.PRICE_SERVICE_URL")
+    p.set_defaults(func=cmd_query)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,70 @@
 import os
 from pathlib import Path, PurePath
 
-from dotenv import load_dotenv
-
 basedir = Path(__file__).parent.parent.parent
 env_path = Path(basedir, ".env")
-load_dotenv(env_path)
+
+_env_loaded = False
+
+
+def load_env():
+    """
+    Read the .env file once, on the first setting accessed. Importing the
+    package does not touch the file system.
+    """
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+
+        load_dotenv(env_path)
+        _env_loaded = True
+
+
+class Env:
+    """
+    Setting read from the environment when accessed, after loading .env
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+
+    def __get__(self, obj, owner=None):
+        load_env()
+        return os.environ.get(self.name, self.default)
 
 
 class Config(object):
-    
+
     # SECMASTER
-    DB_NAME = os.environ.get("DB_NAME")
-    DB_HOST = os.environ.get("DB_HOST")
-    DB_PORT = os.environ.get("DB_PORT")
-    DB_USER = os.environ.get("DB_USER")
-    DB_PASSWORD = os.environ.get("DB_PASSWORD")
+    DB_NAME = Env("DB_NAME")
+    DB_HOST = Env("DB_HOST")
+    DB_PORT = Env("DB_PORT")
+    DB_USER = Env("DB_USER")
+    DB_PASSWORD = Env("DB_PASSWORD")
 
     # NASDAQ FTP
-    NASDAQ_FTP_SERVER = os.environ.get("NASDAQ_FTP_SERVER")
-    NASDAQ_FTP_USER = os.environ.get("NASDAQ_FTP_USER")
-    NASDAQ_FTP_PASS = os.environ.get("NASDAQ_FTP_PASS")
-    NASDAQ_FTP_DIR = os.environ.get("NASDAQ_FTP_DIR")
+    NASDAQ_FTP_SERVER = Env("NASDAQ_FTP_SERVER")
+    NASDAQ_FTP_USER = Env("NASDAQ_FTP_USER")
+    NASDAQ_FTP_PASS = Env("NASDAQ_FTP_PASS")
+    NASDAQ_FTP_DIR = Env("NASDAQ_FTP_DIR")
 
     # TDA
-    TDA_API_KEY = os.environ.get("TDA_API_KEY")
-    TDA_CALLBACK_URL = os.environ.get("TDA_CALLBACK_URL")
+    TDA_API_KEY = Env("TDA_API_KEY")
+    TDA_CALLBACK_URL = Env("TDA_CALLBACK_URL")
+
+    # MARKET DATA PROVIDER: TDA or STUB (offline, for load testing)
+    PRICE_PROVIDER = Env("PRICE_PROVIDER", "TDA")
+
+    # BAR CACHE: in-process memory budget, optional shared on-disk tier
+    BAR_CACHE_MB = Env("BAR_CACHE_MB", "256")
+    BAR_CACHE_DIR = Env("BAR_CACHE_DIR")
+
+    # CHANGE FEED: optional directory for the bar_changes.jsonl stream
+    CHANGE_FEED_DIR = Env("CHANGE_FEED_DIR")
+
+    # PRICE SERVICE: where `secmaster query` finds the running service
+    PRICE_SERVICE_URL = Env("PRICE_SERVICE_URL", "http://127.0.0.1:8050")
 
 
 if __name__ == "__main__":
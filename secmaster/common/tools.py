@@ -1,13 +1,9 @@
+import datetime
 import ftplib
 import logging
 from pathlib import Path
 import socket
 
-from sqlalchemy import create_engine
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import NullPool
-
 from secmaster.common.config import Config
 
 logging.basicConfig(level=logging.INFO)
@@ -43,7 +39,11 @@ class DatabaseConnector:
     :returns SQLAlchemy MYSQL engine or session
     """
 
-    def __init__(self):
+    def __init__(self, pool_size=None):
+        """
+        :param pool_size: keep this many connections open for reuse, long running
+            services should set it. None opens a new connection for every session.
+        """
         db_config = Config()
 
         self.db_user = db_config.DB_USER
@@ -51,21 +51,37 @@ class DatabaseConnector:
         self.db_host = db_config.DB_HOST
         self.db_port = db_config.DB_PORT
         self.db_name = db_config.DB_NAME
+        self.pool_size = pool_size
+        self._engine = None
 
     #  --------------------------------------------
     def engine(self):
         """
         :return:SQLAlchemy engine
         """
+        if self._engine is not None:
+            return self._engine
+
+        from sqlalchemy import create_engine
+        from sqlalchemy.exc import SQLAlchemyError
+        from sqlalchemy.pool import NullPool
 
         db_url = "mysql+pymysql://{}:{}@{}:{}/{}".format(
             self.db_user, self.db_password, self.db_host, self.db_port, self.db_name
         )
         # MYSQL server must be running
         try:
-            # TODO: review how to reuse connections to database
-            # engine = create_engine(db_url)
-            engine = create_engine(db_url, poolclass=NullPool)
+            if self.pool_size is None:
+                engine = create_engine(db_url, poolclass=NullPool)
+            else:
+                engine = create_engine(
+                    db_url,
+                    pool_size=self.pool_size,
+                    max_overflow=self.pool_size,
+                    pool_pre_ping=True,
+                    pool_recycle=3600,
+                )
+            self._engine = engine
             return engine
         except SQLAlchemyError as e:
             logger.error("Database server not responding: {}".format(e))
@@ -75,6 +91,9 @@ class DatabaseConnector:
         """
         :return: sqlalchemy session
         """
+        from sqlalchemy.exc import SQLAlchemyError
+        from sqlalchemy.orm import sessionmaker
+
         try:
             engine = self.engine()
             session_factory = sessionmaker(bind=engine)
@@ -89,6 +108,8 @@ class DatabaseConnector:
         """
         :return: mysql connection object
         """
+        from sqlalchemy.exc import SQLAlchemyError
+
         try:
             engine = self.engine()
             return engine.connect()
@@ -110,6 +131,18 @@ def split_list(lst, chunk):
     return ans
 
 
+def to_naive_utc(d):
+    """
+    Database datetimes are naive UTC, datetimes built from provider data are aware
+
+    :param d: datetime or None
+    :return: naive UTC datetime or None
+    """
+    if d is not None and d.tzinfo is not None:
+        d = d.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return d
+
+
 def progressbar_print(
     iteration,
     total,
@@ -0,0 +1,248 @@
+"""
+Backfill bars for the whole universe across processes or hosts.
+
+Symbols are sharded by a hash of the symbol id. Every shard runs its own
+ingest pipeline with its own database session and an equal share of the
+provider rate limit, so JSON decoding and row building scale with cores.
+
+    # all shards on this host, one process each
+    python -m secmaster.data_manager.backfill --shards 8
+
+    # one shard per host, then aggregate the reports
+    python -m secmaster.data_manager.backfill --shards 8 --shard 3 --report-dir reports/
+    python -m secmaster.data_manager.backfill --aggregate reports/
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import multiprocessing
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from secmaster.common.tools import DatabaseConnector
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Requests per second the provider allows for the whole run, split across shards
+TOTAL_RATE = 20.0
+REPORT_KEYS = [
+    "jobs",
+    "fetched",
+    "empty",
+    "failed",
+    "rows",
+    "quarantined",
+    "batches",
+]
+
+
+def shard_of(symbol, shards):
+    """
+    Stable shard number for a symbol, the same on every host and run
+
+    :param symbol: symbol str
+    :param shards: number of shards
+    :return: int in [0, shards)
+    """
+    return zlib.crc32(symbol.encode()) % shards
+
+
+def shard_symbols(symbols, shards, shard):
+    """
+    :param symbols: list of strings with symbols
+    :param shards: number of shards
+    :param shard: shard number
+    :return: the symbols belonging to the shard
+    """
+    return [x for x in symbols if shard_of(x, shards) == shard]
+
+
+def run_shard(
+    shard,
+    shards,
+    provider_name=None,
+    unwanted=(),
+    total_rate=TOTAL_RATE,
+    progress=None,
+    run_id=None,
+):
+    """
+    Backfill one shard. Runs in its own process, so it opens its own database
+    session and rate limiter.
+
+    :param shard: shard number
+    :param shards: number of shards
+    :param provider_name: provider to fetch from, default Config.PRICE_PROVIDER
+    :param unwanted: list of strings with symbols not to update
+    :param total_rate: requests per second for all shards together
+    :param progress: queue receiving (shard, report) after every flush
+    :param run_id: change feed id shared by all shards, a new one when None
+    :return: report dict
+    """
+    from secmaster.data_manager.pipeline import IngestPipeline
+    from secmaster.data_manager.tda_eod import get_symbols_to_update, get_update_jobs
+    from secmaster.providers.base import get_provider
+    from secmaster.providers.rate_limit import AdaptiveRateLimiter
+
+    session = DatabaseConnector().session()
+    try:
+        symbols = get_symbols_to_update(session, unwanted=list(unwanted))
+        symbols = shard_symbols(symbols, shards, shard)
+        jobs = get_update_jobs(session, symbols)
+
+        provider = get_provider(provider_name)
+        share = total_rate / shards
+        limiter = AdaptiveRateLimiter(
+            f"{provider.name}-{shard}", rate=min(5.0, share), max_rate=share
+        )
+
+        def on_progress(report):
+            if progress is not None:
+                progress.put((shard, report))
+
+        pipeline = IngestPipeline(
+            session, provider, limiter=limiter, progress=on_progress, run_id=run_id
+        )
+        report = asyncio.run(pipeline.run(jobs))
+    finally:
+        session.close()
+
+    report["shard"] = shard
+    report["limiter"] = limiter.stats()
+    on_progress(report)
+    return report
+
+
+def aggregate(reports):
+    """
+    Sum shard reports into the run report
+
+    :param reports: list of shard report dicts
+    :return: dict
+    """
+    ans = {key: sum(x.get(key, 0) for x in reports) for key in REPORT_KEYS}
+    ans["shards"] = len(reports)
+    run_ids = sorted(set(x["run_id"] for x in reports if "run_id" in x))
+    ans["run_id"] = ",".join(run_ids)
+    # shards run in parallel, the slowest one sets the wall time
+    ans["elapsed"] = max((x.get("elapsed", 0) for x in reports), default=0)
+    return ans
+
+
+def _log_progress(progress, shards):
+    latest = {}
+    while True:
+        item = progress.get()
+        if item is None:
+            return
+        shard, report = item
+        latest[shard] = report
+        total = aggregate(list(latest.values()))
+        logger.info(
+            f"{len(latest)}/{shards} shards reporting: "
+            f"{total['fetched'] + total['failed']}/{total['jobs']} symbols, "
+            f"{total['rows']} rows"
+        )
+
+
+def backfill(shards, provider_name=None, unwanted=(), total_rate=TOTAL_RATE):
+    """
+    Run every shard in a process pool and aggregate their reports. A failed
+    shard is logged and left out, the others still report.
+
+    :param shards: number of processes
+    :param provider_name: provider to fetch from, default Config.PRICE_PROVIDER
+    :param unwanted: list of strings with symbols not to update
+    :param total_rate: requests per second for all shards together
+    :return: run report dict, failed_shards lists the shards without a report
+    """
+    from secmaster.db.change_feed import new_run_id
+
+    start_time = datetime.datetime.now()
+    run_id = new_run_id()
+    with multiprocessing.Manager() as manager:
+        progress = manager.Queue()
+        printer = threading.Thread(target=_log_progress, args=(progress, shards))
+        printer.start()
+        try:
+            with ProcessPoolExecutor(max_workers=shards) as pool:
+                futures = [
+                    pool.submit(
+                        run_shard,
+                        shard,
+                        shards,
+                        provider_name,
+                        tuple(unwanted),
+                        total_rate,
+                        progress,
+                        run_id,
+                    )
+                    for shard in range(shards)
+                ]
+                reports = []
+                failed_shards = []
+                for shard, future in enumerate(futures):
+                    try:
+                        reports.append(future.result())
+                    except (Exception, SystemExit) as e:
+                        # the connectors raise SystemExit on database errors
+                        logger.error(f"Shard {shard} failed: {e!r}")
+                        failed_shards.append(shard)
+        finally:
+            progress.put(None)
+            printer.join()
+
+    ans = aggregate(reports)
+    ans["failed_shards"] = failed_shards
+    ans["wall_time"] = str(datetime.datetime.now() - start_time)
+    if failed_shards:
+        logger.warning(f"Backfill partly done, shards {failed_shards} failed: {ans}")
+    else:
+        logger.info(f"Backfill done: {ans}")
+    return ans
+
+
+def aggregate_report_dir(report_dir):
+    """
+    Run report from the shard reports written by several hosts
+
+    :param report_dir: directory with shard_*.json files
+    :return: dict
+    """
+    paths = sorted(Path(report_dir).glob("shard_*.json"))
+    reports = [json.loads(x.read_text()) for x in paths]
+    return aggregate(reports)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded bars backfill")
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--shard", type=int, default=None, help="run only this shard")
+    parser.add_argument("--provider", default=None)
+    parser.add_argument(
+        "--rate", type=float, default=TOTAL_RATE, help="requests/s, all shards"
+    )
+    parser.add_argument("--exclude", nargs="*", default=[], help="symbols not to update")
+    parser.add_argument("--report-dir", default=None, help="write the shard report here")
+    parser.add_argument(
+        "--aggregate", default=None, metavar="DIR", help="sum shard reports"
+    )
+    args = parser.parse_args()
+
+    if args.aggregate is not None:
+        logger.info(f"Backfill report: {aggregate_report_dir(args.aggregate)}")
+    elif args.shard is not None:
+        report = run_shard(
+            args.shard, args.shards, args.provider, args.exclude, args.rate
+        )
+        if args.report_dir is not None:
+            Path(args.report_dir).mkdir(parents=True, exist_ok=True)
+            path = Path(args.report_dir, f"shard_{args.shard}.json")
+            path.write_text(json.dumps(report, default=str))
+    else:
+        backfill(args.shards, args.provider, args.exclude, args.rate)
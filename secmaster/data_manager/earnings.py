@@ -0,0 +1,296 @@
+"""
+Earnings calendar: load the dates from the provider, find who reports next and
+cut the bars around each report.
+
+    update_earnings(s, get_provider("STUB"), workers=8)
+    upcoming = get_upcoming_earnings(s, days=7)
+    slices = get_event_windows(s, upcoming, before=5, after=5)
+
+Dates are upserted on the unique (earning_date, symbol_id) index, so loading the
+same calendar again only refreshes last_updated. The provider is the reference
+for the dates to come: a future date a symbol no longer has was rescheduled and
+is deleted in the transaction of the upsert.
+"""
+import datetime
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import and_, delete, or_, select, tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from secmaster.common.tools import progressbar_print, split_list
+from secmaster.data_manager.update_symbols_info import sanitize_secmaster_to_yahoo
+from secmaster.db.models import PROVIDER_CODES, Bar, EarningDate, Symbol
+from secmaster.db.symbol_ids import get_symbol_dictionary
+from secmaster.providers.base import get_earnings_dates, get_provider
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# symbols fetched and upserted per commit
+BATCH_SYMBOLS = 200
+BAR_FIELDS = ["date", "open", "high", "low", "close", "volume"]
+
+
+def get_symbols_for_earnings(s, symbols=None):
+    """
+    :param s: database session obj
+    :param symbols: optional list of strings with symbols to consider
+    :return: list of strings with the equity symbols to update
+    """
+    stmt = select(Symbol.symbol).where(
+        and_(Symbol.to_update == True, Symbol.quote_type == "EQUITY")
+    )
+    if symbols is not None:
+        stmt = stmt.where(Symbol.symbol.in_(symbols))
+    return [x[0] for x in s.execute(stmt).all()]
+
+
+def build_earning_rows(symbol_id, dates, provider):
+    """
+    :param symbol_id: int
+    :param dates: list of datetimes from the provider
+    :param provider: provider code
+    :return: list of earning_dates row dicts, one per day
+    """
+    now = datetime.datetime.utcnow()
+    days = {datetime.datetime(x.year, x.month, x.day) for x in dates}
+    return [
+        {
+            "symbol_id": symbol_id,
+            "earning_date": x,
+            "provider": provider,
+            "last_updated": now,
+        }
+        for x in sorted(days)
+    ]
+
+
+def upsert_earning_dates(s, rows):
+    """
+    Insert the rows, or refresh provider and last_updated of the dates already
+    known. Does not commit.
+
+    :param s: database session obj
+    :param rows: list of earning_dates row dicts
+    :return: number of rows sent
+    """
+    for chunk in split_list(rows, 5000):
+        stmt = mysql_insert(EarningDate).values(chunk)
+        stmt = stmt.on_duplicate_key_update(
+            provider=stmt.inserted.provider, last_updated=stmt.inserted.last_updated
+        )
+        s.execute(stmt)
+    return len(rows)
+
+
+def lookup_earnings_dates(symbol, provider):
+    """
+    Earnings dates of one symbol. A failed lookup, whatever the provider or the
+    network raised, is logged and left as no dates so the rest of the calendar
+    still loads.
+
+    :param symbol: secmaster symbol str
+    :param provider: PriceProvider
+    :return: list of datetimes or None
+    """
+    try:
+        return get_earnings_dates(sanitize_secmaster_to_yahoo(symbol), provider)
+    except Exception as e:
+        logger.warning(f"{symbol}: earnings lookup failed, {type(e).__name__}: {e}")
+        return None
+
+
+def delete_rescheduled(s, rows, symbol_ids, today):
+    """
+    Delete the future dates of the symbols that are not in rows, dates moved
+    by the company since the last load. Does not commit.
+
+    :param s: database session obj
+    :param rows: list of earning_dates row dicts just fetched
+    :param symbol_ids: list of ints, symbols the rows are the full calendar of
+    :param today: datetime at midnight, dates before it are kept
+    :return: number of dates deleted
+    """
+    if not symbol_ids:
+        return 0
+    stmt = delete(EarningDate).where(
+        EarningDate.symbol_id.in_(symbol_ids), EarningDate.earning_date >= today
+    )
+    fresh = [
+        (x["symbol_id"], x["earning_date"]) for x in rows if x["earning_date"] >= today
+    ]
+    if fresh:
+        stmt = stmt.where(
+            tuple_(EarningDate.symbol_id, EarningDate.earning_date).not_in(fresh)
+        )
+    return s.execute(stmt).rowcount
+
+
+def update_earnings(s, provider=None, symbols=None, workers=1):
+    """
+    Load the earnings dates of every equity symbol. Lookups run in a thread
+    pool, each batch of symbols is upserted in one statement and committed,
+    together with the deletion of the future dates the lookups no longer give.
+    Symbols the provider has no dates for are left as they are.
+
+    :param s: database session obj
+    :param provider: PriceProvider, default from Config.PRICE_PROVIDER
+    :param symbols: optional list of strings with symbols to consider
+    :param workers: lookups in flight
+    :return: number of earnings dates written
+    """
+    logger.info("update earnings initialized.")
+    if provider is None:
+        provider = get_provider()
+    # Yahoo has them, whatever provider gives the prices
+    code = PROVIDER_CODES["YAHOO"] if provider.name == "TDA" else None
+
+    symbols = get_symbols_for_earnings(s, symbols)
+    ids = get_symbol_dictionary().ids(symbols, s)
+    logger.info(f"Ready to update earnings of {len(symbols)} symbols.")
+
+    now = datetime.datetime.utcnow()
+    today = datetime.datetime(now.year, now.month, now.day)
+    written = rescheduled = 0
+    batches = split_list(symbols, BATCH_SYMBOLS)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for n, batch in enumerate(batches):
+            dates = pool.map(lambda x: lookup_earnings_dates(x, provider), batch)
+            rows = []
+            fetched = []
+            for symbol, symbol_dates in zip(batch, dates):
+                if symbol_dates:
+                    rows += build_earning_rows(ids[symbol], symbol_dates, code)
+                    fetched.append(ids[symbol])
+            rescheduled += delete_rescheduled(s, rows, fetched, today)
+            written += upsert_earning_dates(s, rows)
+            s.commit()
+            progressbar_print(n + 1, len(batches))
+
+    logger.info(
+        f"Done, {written} earnings dates of {len(symbols)} symbols,"
+        f" {rescheduled} rescheduled dates deleted."
+    )
+    return written
+
+
+def get_upcoming_earnings(s, days=7, start=None, symbols=None):
+    """
+    Symbols reporting in the next days, a range scan of the earnings index
+
+    :param s: database session obj
+    :param days: calendar days from start, start included
+    :param start: datetime, default today
+    :param symbols: optional list of strings with symbols to consider
+    :return: pandas DataFrame with columns symbol, earning_date, by date
+    """
+    import pandas as pd
+
+    if start is None:
+        start = datetime.datetime.utcnow()
+    start = datetime.datetime(start.year, start.month, start.day)
+    end = start + datetime.timedelta(days=days)
+
+    stmt = (
+        select(Symbol.symbol, EarningDate.earning_date)
+        .join(Symbol, Symbol.id == EarningDate.symbol_id)
+        .where(EarningDate.earning_date >= start, EarningDate.earning_date < end)
+        .order_by(EarningDate.earning_date, Symbol.symbol)
+    )
+    if symbols is not None:
+        stmt = stmt.where(Symbol.symbol.in_(symbols))
+    return pd.DataFrame(s.execute(stmt).all(), columns=["symbol", "earning_date"])
+
+
+def _read_bars_around(s, ranges):
+    """
+    :param ranges: dict symbol id -> (first, last) datetime to read
+    :return: list of (symbol_id, date, open, high, low, close, volume)
+    """
+    ans = []
+    for chunk in split_list(list(ranges.items()), BATCH_SYMBOLS):
+        # one range per symbol, each a seek on the (symbol_id, date) index
+        stmt = (
+            select(Bar.symbol_id, *[Bar.__table__.c[x] for x in BAR_FIELDS])
+            .where(
+                or_(
+                    *[
+                        and_(Bar.symbol_id == i, Bar.date.between(first, last))
+                        for i, (first, last) in chunk
+                    ]
+                )
+            )
+            .order_by(Bar.symbol_id, Bar.date)
+        )
+        ans += s.execute(stmt).all()
+    return ans
+
+
+def get_event_windows(s, events, before=5, after=5):
+    """
+    Bars around each event, every event in one pass. Day 0 is the first session
+    on or after the earnings date, -1 the one before it.
+
+    :param s: database session obj
+    :param events: DataFrame with columns symbol and earning_date, like
+        get_upcoming_earnings returns
+    :param before: sessions before day 0
+    :param after: sessions after day 0
+    :return: pandas DataFrame with columns symbol, earning_date, offset and the
+        bar fields, by event and offset. Sessions not stored are left out.
+    """
+    import pandas as pd
+
+    columns = ["symbol", "earning_date", "offset"] + BAR_FIELDS
+    events = events[["symbol", "earning_date"]].drop_duplicates()
+    ids = get_symbol_dictionary().ids(events["symbol"].unique().tolist(), s)
+    events = events.assign(symbol_id=events["symbol"].map(ids)).dropna()
+    if events.empty:
+        return pd.DataFrame(columns=columns)
+    events["symbol_id"] = events["symbol_id"].astype("int64")
+    events["earning_date"] = pd.to_datetime(events["earning_date"])
+
+    # calendar days enough for the sessions asked, holidays included
+    pad_before = pd.Timedelta(days=before * 7 // 5 + 7)
+    pad_after = pd.Timedelta(days=after * 7 // 5 + 7)
+    spans = events.groupby("symbol_id")["earning_date"].agg(["min", "max"])
+    ranges = {
+        i: ((first - pad_before).to_pydatetime(), (last + pad_after).to_pydatetime())
+        for i, first, last in spans.itertuples()
+    }
+    bars = pd.DataFrame(
+        _read_bars_around(s, ranges), columns=["symbol_id"] + BAR_FIELDS
+    )
+    if bars.empty:
+        return pd.DataFrame(columns=columns)
+    bars["date"] = pd.to_datetime(bars["date"])
+    bars["position"] = bars.groupby("symbol_id").cumcount()
+
+    # position of day 0 of every event
+    anchors = pd.merge_asof(
+        events.sort_values("earning_date"),
+        bars[["symbol_id", "date", "position"]].sort_values("date"),
+        left_on="earning_date",
+        right_on="date",
+        by="symbol_id",
+        direction="forward",
+        # no session in a week, the bars of the event are missing
+        tolerance=pd.Timedelta(days=7),
+    ).dropna(subset=["position"])
+
+    offsets = pd.DataFrame({"offset": range(-before, after + 1)})
+    windows = anchors[["symbol", "symbol_id", "earning_date", "position"]].merge(
+        offsets, how="cross"
+    )
+    windows["position"] = windows["position"].astype("int64") + windows["offset"]
+    windows = windows.merge(bars, on=["symbol_id", "position"])
+    ans = windows[columns].sort_values(["earning_date", "symbol", "offset"])
+    return ans.reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    from secmaster.cli import main
+
+    sys.exit(main(["earnings"] + sys.argv[1:]))
@@ -0,0 +1,280 @@
+import datetime
+import logging
+from collections import deque
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from secmaster.common.tools import DatabaseConnector, split_list, to_naive_utc
+from secmaster.db.models import Bar, Feature, FeatureState
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SMA_WINDOWS = {"sma_20": 20, "sma_50": 50, "sma_200": 200}
+ATR_WINDOW = 14
+ADV_WINDOW = 20
+FEATURES = ["ret_1d", "sma_20", "sma_50", "sma_200", "atr_14", "adv_20"]
+
+
+class RollingIndicators:
+    """
+    Indicators of one symbol, updated one bar at a time in O(1).
+
+    Simple averages keep a running sum: the new value is added and the one
+    leaving the window subtracted. ATR uses Wilder's smoothing, which needs only
+    the previous ATR. The whole state is plain lists and floats, stored as JSON
+    in feature_states.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        longest = max(SMA_WINDOWS.values())
+        self.closes = deque(state.get("closes", []), maxlen=longest)
+        self.volumes = deque(state.get("volumes", []), maxlen=ADV_WINDOW)
+        self.sums = state.get("sums") or {k: 0.0 for k in SMA_WINDOWS}
+        self.volume_sum = state.get("volume_sum", 0.0)
+        self.atr = state.get("atr")
+        self.count = state.get("count", 0)
+
+    def update(self, high, low, close, volume):
+        """
+        :return: dict of features for this bar, None while a window is not full
+        """
+        prev_close = self.closes[-1] if self.closes else None
+
+        for name, n in SMA_WINDOWS.items():
+            self.sums[name] += close
+            if len(self.closes) >= n:
+                self.sums[name] -= self.closes[-n]
+        self.closes.append(close)
+
+        self.volume_sum += volume
+        if len(self.volumes) >= ADV_WINDOW:
+            self.volume_sum -= self.volumes[0]
+        self.volumes.append(volume)
+
+        if prev_close is None:
+            true_range = high - low
+        else:
+            true_range = max(high - low, abs(high - prev_close), abs(low - prev_close))
+        if self.atr is None:
+            self.atr = true_range
+        else:
+            self.atr += (true_range - self.atr) / ATR_WINDOW
+        self.count += 1
+
+        ans = {
+            name: self.sums[name] / n if self.count >= n else None
+            for name, n in SMA_WINDOWS.items()
+        }
+        ans["ret_1d"] = close / prev_close - 1 if prev_close else None
+        ans["atr_14"] = self.atr if self.count >= ATR_WINDOW else None
+        ans["adv_20"] = self.volume_sum / ADV_WINDOW if self.count >= ADV_WINDOW else None
+        return ans
+
+    def state(self):
+        return {
+            "closes": list(self.closes),
+            "volumes": list(self.volumes),
+            "sums": self.sums,
+            "volume_sum": self.volume_sum,
+            "atr": self.atr,
+            "count": self.count,
+        }
+
+
+def update_features(s, rows):
+    """
+    Incremental update for newly written bars. Called by the bar writer, does not
+    commit. Symbols without a stored state are rebuilt from their full history.
+    Bars not newer than the state are ignored; corrections need rebuild_features.
+
+    :param s: database session obj
+    :param rows: list of bar row dicts, any number of symbols
+    :return: number of feature rows written
+    """
+    by_symbol = {}
+    for row in rows:
+        by_symbol.setdefault(row["symbol_id"], []).append(row)
+    if not by_symbol:
+        return 0
+
+    stmt = select(FeatureState).where(FeatureState.symbol_id.in_(list(by_symbol)))
+    states = {x[0].symbol_id: x[0] for x in s.execute(stmt).all()}
+
+    missing = [x for x in by_symbol if x not in states]
+    written = rebuild_features(s, missing, commit=False) if missing else 0
+
+    feature_rows = []
+    state_rows = []
+    now = datetime.datetime.utcnow()
+    for symbol, symbol_rows in by_symbol.items():
+        if symbol not in states:
+            continue
+        stored = states[symbol]
+        indicators = RollingIndicators(stored.state)
+        last_date = stored.date
+        for row in sorted(symbol_rows, key=lambda x: x["date"]):
+            date = to_naive_utc(row["date"])
+            if last_date is not None and date <= last_date:
+                logger.warning(f"{symbol} bar {date} not after features state, skipped")
+                continue
+            values = indicators.update(
+                row["high"], row["low"], row["close"], row["volume"]
+            )
+            feature_rows.append(
+                {"symbol_id": symbol, "date": date, "last_updated": now, **values}
+            )
+            last_date = date
+        state_rows.append(
+            {
+                "symbol_id": symbol,
+                "date": last_date,
+                "state": indicators.state(),
+                "last_updated": now,
+            }
+        )
+
+    _save(s, feature_rows, state_rows)
+    return written + len(feature_rows)
+
+
+def _save(s, feature_rows, state_rows):
+    if feature_rows:
+        stmt = mysql_insert(Feature).values(feature_rows)
+        s.execute(
+            stmt.on_duplicate_key_update(
+                {k: stmt.inserted[k] for k in FEATURES + ["last_updated"]}
+            )
+        )
+    if state_rows:
+        stmt = mysql_insert(FeatureState).values(state_rows)
+        s.execute(
+            stmt.on_duplicate_key_update(
+                date=stmt.inserted.date,
+                state=stmt.inserted.state,
+                last_updated=stmt.inserted.last_updated,
+            )
+        )
+
+
+def compute_features_frame(bars):
+    """
+    Vectorized features for full histories, same results as RollingIndicators
+
+    :param bars: pandas DataFrame with symbol_id, date, high, low, close, volume
+    :return: DataFrame with symbol_id, date and the FEATURES columns
+    """
+    import pandas as pd
+
+    bars = bars.sort_values(["symbol_id", "date"]).reset_index(drop=True)
+    by_symbol = bars.groupby("symbol_id", sort=False)
+    ans = bars[["symbol_id", "date"]].copy()
+
+    for name, n in SMA_WINDOWS.items():
+        ans[name] = by_symbol["close"].transform(lambda x: x.rolling(n).mean())
+    ans["adv_20"] = by_symbol["volume"].transform(
+        lambda x: x.rolling(ADV_WINDOW).mean()
+    )
+    prev_close = by_symbol["close"].shift()
+    ans["ret_1d"] = bars["close"] / prev_close - 1
+
+    true_range = pd.concat(
+        [
+            bars["high"] - bars["low"],
+            (bars["high"] - prev_close).abs(),
+            (bars["low"] - prev_close).abs(),
+        ],
+        axis=1,
+    ).max(axis=1)
+    # Wilder's smoothing is an ewm with alpha 1/n seeded with the first value
+    atr = true_range.groupby(bars["symbol_id"], sort=False).transform(
+        lambda x: x.ewm(alpha=1 / ATR_WINDOW, adjust=False).mean()
+    )
+    position = by_symbol.cumcount()
+    ans["atr_14"] = atr.where(position >= ATR_WINDOW - 1)
+    ans["_atr"] = atr
+    return ans
+
+
+def _final_state(bars, features):
+    """
+    RollingIndicators state after the last bar of one symbol's history
+    """
+    closes = bars["close"].tolist()[-max(SMA_WINDOWS.values()) :]
+    volumes = bars["volume"].tolist()[-ADV_WINDOW:]
+    return {
+        "closes": closes,
+        "volumes": volumes,
+        "sums": {k: float(sum(closes[-n:])) for k, n in SMA_WINDOWS.items()},
+        "volume_sum": float(sum(volumes)),
+        "atr": float(features["_atr"].iloc[-1]),
+        "count": len(bars),
+    }
+
+
+def rebuild_features(s, symbols, chunk=200, commit=True):
+    """
+    Recompute features and states from the full bar history, vectorized, a
+    chunk of symbols at a time. Use after a backfill or a data correction.
+
+    :param s: database session obj
+    :param symbols: list of symbol ids
+    :param chunk: symbols read and computed together
+    :param commit: commit after each chunk
+    :return: number of feature rows written
+    """
+    import pandas as pd
+
+    written = 0
+    for symbols_chunk in split_list(list(symbols), chunk):
+        stmt = select(
+            Bar.symbol_id, Bar.date, Bar.high, Bar.low, Bar.close, Bar.volume
+        ).where(Bar.symbol_id.in_(symbols_chunk))
+        bars = pd.DataFrame(
+            s.execute(stmt).all(),
+            columns=["symbol_id", "date", "high", "low", "close", "volume"],
+        )
+        s.execute(delete(Feature).where(Feature.symbol_id.in_(symbols_chunk)))
+        if bars.empty:
+            continue
+        bars = bars.sort_values(["symbol_id", "date"]).reset_index(drop=True)
+        features = compute_features_frame(bars)
+
+        now = datetime.datetime.utcnow()
+        state_rows = []
+        for symbol, index in bars.groupby("symbol_id", sort=False).groups.items():
+            state_rows.append(
+                {
+                    "symbol_id": symbol,
+                    "date": bars.loc[index[-1], "date"].to_pydatetime(),
+                    "state": _final_state(bars.loc[index], features.loc[index]),
+                    "last_updated": now,
+                }
+            )
+
+        features = features.drop(columns="_atr")
+        features["last_updated"] = now
+        features = features.astype(object).where(features.notna(), None)
+        feature_rows = features.to_dict("records")
+        for each in split_list(feature_rows, 10000):
+            s.execute(mysql_insert(Feature).values(each))
+        _save(s, [], state_rows)
+        if commit:
+            s.commit()
+        written += len(feature_rows)
+    return written
+
+
+if __name__ == "__main__":
+    connector = DatabaseConnector()
+    Feature.__table__.create(connector.engine(), checkfirst=True)
+    FeatureState.__table__.create(connector.engine(), checkfirst=True)
+
+    db_session = connector.session()
+    symbols = [x[0] for x in db_session.execute(select(Bar.symbol_id).distinct()).all()]
+    logger.info(f"Rebuilding features for {len(symbols)} symbols")
+    n = rebuild_features(db_session, symbols)
+    logger.info(f"{n} feature rows written")
+    db_session.close()
@@ -0,0 +1,152 @@
+"""
+Run the data pipelines as a dependency graph.
+
+A stage starts as soon as the stages it depends on are done, so independent
+stages run at the same time, each in its own thread with its own database
+session. A failed stage skips everything depending on it.
+
+    symbols --+--> info
+              +--> eod
+"""
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from secmaster.common.tools import get_project_root
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+UNIVERSE_DIR = Path(get_project_root(), "assets", "indices_constituents")
+
+
+class Stage:
+    """
+    One node of the graph
+    """
+
+    def __init__(self, name, run, after=(), plan=None):
+        """
+        :param name: stage name
+        :param run: callable without arguments doing the work, returns a report
+        :param after: names of the stages that must finish first
+        :param plan: callable without arguments describing the work, for dry runs
+        """
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+        self.plan = plan
+
+
+def order_stages(stages):
+    """
+    Stages grouped in levels, every stage after all its dependencies.
+    Dependencies outside the given stages are ignored, so a subset of the
+    graph can run on its own.
+
+    :param stages: list of Stage
+    :return: list of lists of Stage
+    """
+    names = {x.name for x in stages}
+    pending = {x.name: x for x in stages}
+    done = set()
+    ans = []
+    while pending:
+        level = [
+            x
+            for x in pending.values()
+            if all(d in done or d not in names for d in x.after)
+        ]
+        if not level:
+            raise ValueError(f"Stages with circular dependencies: {list(pending)}")
+        for x in level:
+            del pending[x.name]
+        done.update(x.name for x in level)
+        ans.append(level)
+    return ans
+
+
+def run_stages(stages, dry_run=False):
+    """
+    Run the graph, independent stages concurrently
+
+    :param stages: list of Stage
+    :param dry_run: only log what every stage would do
+    :return: dict stage name -> {"status": done|failed|skipped, "report" or "error"}
+    """
+    levels = order_stages(stages)
+    if dry_run:
+        for n, level in enumerate(levels):
+            for stage in level:
+                plan = stage.plan() if stage.plan is not None else "no plan available"
+                logger.info(f"[dry run] step {n + 1} {stage.name}: {plan}")
+        return {x.name: {"status": "planned"} for x in stages}
+
+    names = {x.name for x in stages}
+    waiting = {x.name: x for x in stages}
+    results = {}
+
+    def timed(stage):
+        start = time.monotonic()
+        report = stage.run()
+        return report, round(time.monotonic() - start, 2)
+
+    with ThreadPoolExecutor(max_workers=len(stages) or 1) as pool:
+        running = {}
+        while waiting or running:
+            for stage in list(waiting.values()):
+                status = [
+                    results.get(d, {}).get("status") for d in stage.after if d in names
+                ]
+                if "failed" in status or "skipped" in status:
+                    del waiting[stage.name]
+                    results[stage.name] = {"status": "skipped"}
+                    logger.warning(f"Stage {stage.name} skipped, a dependency failed")
+                elif all(x == "done" for x in status):
+                    del waiting[stage.name]
+                    logger.info(f"Stage {stage.name} started")
+                    running[pool.submit(timed, stage)] = stage
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    report, elapsed = future.result()
+                # the connectors log and raise SystemExit on database errors
+                except (Exception, SystemExit) as e:
+                    logger.exception(f"Stage {stage.name} failed")
+                    results[stage.name] = {"status": "failed", "error": repr(e)}
+                else:
+                    logger.info(f"Stage {stage.name} done in {elapsed}s")
+                    results[stage.name] = {
+                        "status": "done",
+                        "report": report,
+                        "elapsed": elapsed,
+                    }
+    return results
+
+
+def universe_names():
+    """
+    :return: list of the index constituent files available, like SP500
+    """
+    return sorted(x.stem for x in UNIVERSE_DIR.glob("*.csv"))
+
+
+def universe_symbols(name):
+    """
+    Constituents of an index, one symbol per line in
+    assets/indices_constituents/<name>.csv
+
+    :param name: index name, like NASDAQ100
+    :return: list of strings with symbols
+    """
+    path = Path(UNIVERSE_DIR, f"{name.upper()}.csv")
+    if not path.exists():
+        logger.error(f"Unknown universe {name}, available: {universe_names()}")
+        raise SystemExit(1)
+    with open(path) as f:
+        return [x.strip() for x in f if x.strip()]
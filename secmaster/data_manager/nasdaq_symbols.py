@@ -1,14 +1,14 @@
 import logging
+import sys
 import time
 from pathlib import Path
-import pandas as pd
-import yfinance as yf
 
 from secmaster.common.tools import ftp_server, progressbar_print, get_project_root
 from secmaster.common.config import Config
 
-from secmaster.common.tools import DatabaseConnector
 from secmaster.db.models import Symbol, Provider
+# get_symbol_info lives with the providers, kept importable from here
+from secmaster.providers.base import get_symbol_info
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -72,15 +72,15 @@ def exclude_symbol(string, exclude_list):
     return False
 
 
-def validate_provider(s, filename, provider_id):
+def validate_provider(s, filename, provider_name):
     """
 
     :param s:
     :param filename:
-    :param provider_id:
-    :return:
+    :param provider_name: name in the providers table, like NASDAQ
+    :return: provider code
     """
-    ans = s.query(Provider.id).where(Provider.id == provider_id).first()[0]
+    ans = s.query(Provider.id).where(Provider.name == provider_name).first()
 
     if ans is None:
         logger.error(
@@ -90,21 +90,7 @@ def validate_provider(s, filename, provider_id):
         )
         raise SystemExit
     else:
-        return ans
-
-
-def get_symbol_info(symbol):
-    """ """
-
-    ticket = yf.Ticker(symbol)
-    i = ticket.info
-
-    try:
-        _validate = i["shortName"]
-        _validate = i["symbol"]
-        return i
-    except KeyError:
-        return None
+        return ans[0]
 
 
 def sanitize_symbol_nasdaq_to_tda(symbol):
@@ -131,11 +117,13 @@ def update_database_symbols(s, filepath, cols, exclude_characters, provider_id):
     :param provider_id:
     :return:
     """
+    import pandas as pd
+
     filename = Path(filepath).parts[-1]
     logger.info('Starting database update for file "{}".'.format(filename))
 
     # get symbols already in the database
-    symbols_in_db = [x[0] for x in s.query(Symbol.id).all()]
+    symbols_in_db = set(x[0] for x in s.query(Symbol.symbol).all())
 
     # some counters
     exclude = 0
@@ -166,7 +154,10 @@ def update_database_symbols(s, filepath, cols, exclude_characters, provider_id):
                     # create new symbol
                     symbols_to_add.append(
                         Symbol(
-                            id=symbol, name=name, provider=provider_id, to_update=True
+                            symbol=symbol,
+                            name=name,
+                            provider=provider_id,
+                            to_update=True,
                         )
                     )
                     new_symbols += 1
@@ -193,24 +184,22 @@ def update_database_symbols(s, filepath, cols, exclude_characters, provider_id):
     return ans
 
 
-if __name__ == "__main__":
+def update_nasdaq_symbols(s, download=True):
     """
     Get a list of all stock symbols from NASDAQ and update the database
     https://quant.stackexchange.com/questions/1640/where-to-download-list-of-all-common-stocks-traded-on-nyse-nasdaq-and-amex
     https://www.nasdaqtrader.com/trader.aspx?id=symboldirdefs
-    """
-    DOWNLOAD = True
-
-
-    # database session
-    db_session = DatabaseConnector().session()
 
+    :param s: database session obj
+    :param download: get fresh files from the NASDAQ FTP, else use the ones on disk
+    :return: list of dicts, one per file processed
+    """
     # where downloaded files are to be stored
     destination = Path(get_project_root(), "assets", "symbols_directory")
     destination.mkdir(parents=True, exist_ok=True)
 
     # download the files
-    if DOWNLOAD:
+    if download:
         downloaded = download_nasdaq_files(
             ftp_host=Config.NASDAQ_FTP_SERVER,
             ftp_dir=Config.NASDAQ_FTP_DIR,
@@ -223,16 +212,24 @@ if __name__ == "__main__":
         downloaded = True
 
     # and update the db with the nasdaq files info
+    ans = []
     if downloaded:
         for f in FILES:
             result = update_database_symbols(
-                s=db_session,
+                s=s,
                 filepath=Path(destination, f["filename"]),
                 cols=f["cols"],
                 exclude_characters=f["exclude"],
                 provider_id=validate_provider(
-                    s=db_session, filename=f["filename"], provider_id=f["provider"]
+                    s=s, filename=f["filename"], provider_name=f["provider"]
                 ),
             )
+            ans.append(result)
     logger.info("New symbols created, but have not industry data")
-    db_session.close()
+    return ans
+
+
+if __name__ == "__main__":
+    from secmaster.cli import main
+
+    sys.exit(main(["symbols"] + sys.argv[1:]))
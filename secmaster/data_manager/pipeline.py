@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+
+from secmaster.data_manager.tda_eod import (
+    build_bar_rows,
+    fetch_many,
+    update_symbol_to_update_status,
+    write_bars,
+)
+from secmaster.db.change_feed import new_run_id
+from secmaster.db.symbol_ids import get_symbol_dictionary
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# end of stream marker between stages
+DONE = object()
+
+
+class IngestPipeline:
+    """
+    Staged EOD ingest: fetchers -> parsers -> batching writer.
+
+    Stages are linked by bounded queues. When the database is slow the writer
+    stops taking rows, the queues fill up and the fetchers pause, so memory stays
+    flat while network and database work overlap. Closing drains every queue and
+    flushes the last batch. The writer validates each batch before the insert,
+    rows failing a check go to quarantined_bars.
+
+        pipeline = IngestPipeline(session, provider)
+        report = asyncio.run(pipeline.run(jobs))
+    """
+
+    def __init__(
+        self,
+        s,
+        provider,
+        limiter=None,
+        fetchers=32,
+        parsers=2,
+        queue_size=256,
+        batch_rows=20000,
+        flush_interval=5.0,
+        progress=None,
+        run_id=None,
+    ):
+        """
+        :param s: database session obj, used only by the writer
+        :param provider: PriceProvider
+        :param limiter: AdaptiveRateLimiter, default the shared one for the provider
+        :param fetchers: requests in flight
+        :param parsers: parser tasks
+        :param queue_size: capacity of each queue between stages
+        :param batch_rows: flush when the batch has this many rows
+        :param flush_interval: flush when the oldest row waited this many seconds
+        :param progress: callable receiving the report after every flush
+        :param run_id: id of the writes in the change feed, a new one when None
+        """
+        self.s = s
+        self.provider = provider
+        self.limiter = limiter
+        self.fetchers = fetchers
+        self.parsers = parsers
+        self.queue_size = queue_size
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.progress = progress
+        self.run_id = run_id or new_run_id()
+
+        self.report = {
+            "run_id": self.run_id,
+            "jobs": 0,
+            "fetched": 0,
+            "empty": 0,
+            "failed": 0,
+            "rows": 0,
+            "quarantined": 0,
+            "batches": 0,
+        }
+
+    async def run(self, jobs):
+        """
+        :param jobs: list of (symbol, date_from, date_to)
+        :return: report dict
+        """
+        start = time.monotonic()
+        self.report["jobs"] = len(jobs)
+        # parsers map symbols to ids from memory, not from the event loop
+        await asyncio.to_thread(get_symbol_dictionary().ids, [x[0] for x in jobs])
+        responses = asyncio.Queue(maxsize=self.queue_size)
+        rows = asyncio.Queue(maxsize=self.queue_size)
+
+        async with self.provider:
+            fetcher = asyncio.create_task(self._fetch(jobs, responses))
+            parsers = [
+                asyncio.create_task(self._parse(responses, rows))
+                for _ in range(self.parsers)
+            ]
+            writer = asyncio.create_task(self._write(rows))
+
+            async def feed():
+                await fetcher
+                for _ in parsers:
+                    await responses.put(DONE)
+                await asyncio.gather(*parsers)
+                await rows.put(DONE)
+
+            feeder = asyncio.create_task(feed())
+            try:
+                # unlike gather, wait does not cancel the writer if we are cancelled
+                done, _ = await asyncio.wait(
+                    {feeder, writer}, return_when=asyncio.FIRST_EXCEPTION
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+            except BaseException:
+                # stop fetching, but write what was already parsed
+                for task in (feeder, fetcher, *parsers):
+                    task.cancel()
+                await asyncio.gather(feeder, fetcher, *parsers, return_exceptions=True)
+                if not writer.done():
+                    await rows.put(DONE)
+                    await writer
+                raise
+
+        self.report["elapsed"] = round(time.monotonic() - start, 2)
+        logger.info(f"Ingest done: {self.report}")
+        return self.report
+
+    async def _fetch(self, jobs, responses):
+        async for symbol, response in fetch_many(
+            self.provider, jobs, self.fetchers, self.limiter
+        ):
+            if isinstance(response, Exception):
+                self.report["failed"] += 1
+                logger.warning(f"Giving up on {symbol}: {response}")
+                continue
+            self.report["fetched"] += 1
+            await responses.put((symbol, response))
+
+    async def _parse(self, responses, rows):
+        while True:
+            item = await responses.get()
+            if item is DONE:
+                return
+            symbol, response = item
+            if response["empty"] == True:
+                # Change Symbol.to_update if you need to query a symbol
+                self.report["empty"] += 1
+                await rows.put((symbol, None))
+            else:
+                await rows.put((symbol, build_bar_rows(symbol, response["candles"])))
+
+    async def _write(self, rows):
+        batch = []
+        inactive = []
+        first_at = None
+        while True:
+            timeout = None
+            if first_at is not None:
+                timeout = max(0.0, first_at + self.flush_interval - time.monotonic())
+            try:
+                item = await asyncio.wait_for(rows.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+
+            if item is not None and item is not DONE:
+                symbol, symbol_rows = item
+                if symbol_rows is None:
+                    inactive.append(symbol)
+                else:
+                    batch.extend(symbol_rows)
+                if first_at is None:
+                    first_at = time.monotonic()
+
+            full = len(batch) >= self.batch_rows
+            late = (
+                first_at is not None
+                and time.monotonic() - first_at >= self.flush_interval
+            )
+            if item is DONE or full or late:
+                await asyncio.to_thread(self._flush, batch, inactive)
+                batch, inactive, first_at = [], [], None
+            if item is DONE:
+                return
+
+    def _flush(self, batch, inactive):
+        if batch:
+            written = write_bars(self.s, batch, run_id=self.run_id)
+            self.report["rows"] += written
+            self.report["quarantined"] += len(batch) - written
+            self.report["batches"] += 1
+        for symbol in inactive:
+            update_symbol_to_update_status(self.s, symbol, False)
+        if self.progress is not None:
+            self.progress(dict(self.report))
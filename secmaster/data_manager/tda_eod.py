@@ -1,20 +1,41 @@
+import asyncio
 import datetime
 import logging
+import sys
 import time
 from datetime import timedelta
-from pprint import pprint
 
-import holidays
-from numpy import maximum
-import pytz
-from secmaster.common.tools import DatabaseConnector, progressbar_print
-from secmaster.db.models import Bar, Symbol
-from secmaster.tda_client.tda_client import get_tda_client
-from sqlalchemy import func, select, update
+from secmaster.common.tools import split_list
+from secmaster.data_manager.features import update_features
+from secmaster.data_manager.validation import (
+    exchange_window,
+    quarantine_rows,
+    session_date,
+    validate_rows,
+)
+from secmaster.db.bar_cache import get_bar_cache
+from secmaster.db.change_feed import get_change_feed, new_run_id, record_changes
+from secmaster.db.latest_bars import get_last_dates, upsert_latest_bars
+from secmaster.db.models import INTERVAL_CODES, PROVIDER_CODES, Bar, Symbol
+from secmaster.db.symbol_ids import get_symbol_dictionary
+from secmaster.providers.base import PriceProvider, get_provider
+from secmaster.providers.rate_limit import (
+    ProviderError,
+    ThrottledError,
+    TransportError,
+    check_response,
+    get_rate_limiter,
+    is_transport_error,
+    parse_retry_after,
+)
+from sqlalchemy import func, insert, select, update
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Attempts for a symbol failing with errors other than throttling
+MAX_ATTEMPTS = 3
+
 
 def get_last_candle(s, symbol, field=None):
     """
@@ -26,10 +47,17 @@ def get_last_candle(s, symbol, field=None):
     :param field: The name of the data filed. Must exist on the Bar object
     :return: Bar obj or datafield str, datetime, etc
     """
-    # Get maximum date
     try:
-        stmt = select(func.max(Bar.date)).where(Bar.symbol_id == symbol)
-        last_date = s.execute(stmt).first()[0]
+        symbol_id = get_symbol_dictionary().id_of(symbol, s)
+    except KeyError:
+        return None
+
+    # Get maximum date, from the snapshot table when the symbol is there
+    try:
+        last_date = get_last_dates(s, [symbol_id]).get(symbol_id)
+        if last_date is None:
+            stmt = select(func.max(Bar.date)).where(Bar.symbol_id == symbol_id)
+            last_date = s.execute(stmt).first()[0]
         # Quick exit if you want only the date
         if field == "date":
             return last_date
@@ -38,7 +66,7 @@ def get_last_candle(s, symbol, field=None):
 
     # Process if you want something else
     try:
-        stmt = select(Bar).where(Bar.symbol_id == symbol and Bar.date == last_date)
+        stmt = select(Bar).where(Bar.symbol_id == symbol_id, Bar.date == last_date)
         last_bar = s.execute(stmt).first()[0]
         if field is None:
             return last_bar
@@ -55,6 +83,8 @@ def previous_working_day(a_date):
     :param a_date: datetime date
     :return: The previous US working date for a given date.
     """
+    import holidays
+
     x = a_date.weekday()
     us_holidays = holidays.USA(years=a_date.year)
 
@@ -72,8 +102,7 @@ def previous_working_day(a_date):
 
 def sanitize_response(resp):
     """
-    Delete candles with Nan values
-    None for empty responses
+    "NaN" values become None, the validation stage quarantines those candles
     :param resp:
     :return: corrected resp
     """
@@ -83,107 +112,236 @@ def sanitize_response(resp):
     # if resp["empty"] == True:
     #     return None
 
-    ans = []
-    for d in resp["candles"]:
-        if (
-            d["open"] == "NaN"
-            or d["high"] == "NaN"
-            or d["low"] == "NaN"
-            or d["close"] == "NaN"
-            or d["volume"] == "NaN"
-        ):
-            continue
-        else:
-            ans.append(d)
-
-    resp["candles"] = ans
+    fields = ["open", "high", "low", "close", "volume"]
+    resp["candles"] = [
+        {k: (None if k in fields and v == "NaN" else v) for k, v in d.items()}
+        for d in resp["candles"]
+    ]
     return resp
 
 
-def get_tda_prices(client, symbol, date_from=None, date_to=None):
+def release_response(limiter, r, latency):
+    """
+    Give the limiter slot back according to the response. 200 and 429 drive
+    the AIMD state, any other status only trims the rate.
+
+    :raise ThrottledError: on a 429
+    """
+    if r.status_code == 429:
+        retry_after = parse_retry_after(r.headers)
+        limiter.release(throttled=True, retry_after=retry_after)
+        raise ThrottledError(retry_after)
+    if r.status_code == 200:
+        limiter.release(latency=latency)
+    else:
+        limiter.release(failed=True)
+
+
+def get_tda_prices(client, symbol, date_from=None, date_to=None, limiter=None):
     """
-    For a given symbol get market prices
+    For a given symbol get market prices. Requests are paced by the provider's
+    adaptive rate limiter, a 429 raises ThrottledError so the caller can requeue.
+    Other statuses raise ProviderError and network failures TransportError,
+    both worth a retry.
 
 
-    :param session: SECMASTER session
-    :param client: tda client
+    :param client: PriceProvider, or a tda client to be wrapped in a TDAProvider
     :param symbol: stock symbol
-    :param tda_query_delay: time in seconds as float, you dont want to upset TDA server.
-    :return: _description_
+    :param date_from: first session date or None for all bars available
+    :param date_to: last session date
+    :param limiter: AdaptiveRateLimiter, default the shared one for the provider
+    :return: sanitized response dict
     
     """
 
     # Some logging messages in tda/auth.py best muted
+    if not isinstance(client, PriceProvider):
+        from secmaster.providers.tda import TDAProvider
 
-    if date_from is None:
-        # Get all bars available
-        r = client.get_price_history(
-            symbol,
-            period_type=client.PriceHistory.PeriodType.YEAR,
-            period=client.PriceHistory.Period.TWENTY_YEARS,
-            frequency_type=client.PriceHistory.FrequencyType.DAILY,
-            frequency=client.PriceHistory.Frequency.DAILY,
-            need_extended_hours_data=False,
-        )
-    else:
-        # or get bars within a date range
-        r = client.get_price_history(
-            symbol,
-            period_type=client.PriceHistory.PeriodType.YEAR,
-            start_datetime=date_from,
-            end_datetime=date_to,
-            frequency_type=client.PriceHistory.FrequencyType.DAILY,
-            frequency=client.PriceHistory.Frequency.DAILY,
-            need_extended_hours_data=False,
-        )
+        client = TDAProvider(client)
+    if limiter is None:
+        limiter = get_rate_limiter(client.name)
+
+    date_from, date_to = exchange_window(date_from, date_to)
+    limiter.acquire()
+    start = time.monotonic()
+    try:
+        r = client.get_price_history(symbol, date_from, date_to)
+    except Exception as e:
+        limiter.release(failed=True)
+        if is_transport_error(e):
+            raise TransportError(e) from e
+        raise
 
-    assert r.status_code == 200, r.raise_for_status()
+    release_response(limiter, r, time.monotonic() - start)
+
+    check_response(r)
     ans = sanitize_response(r)
     return ans
 
 
-def update_bars(s, symbol, tda_bars):
+async def aget_tda_prices(provider, symbol, date_from=None, date_to=None, limiter=None):
     """
+    Async get_tda_prices, requests go over the provider's shared connection pool
 
-    :param session:
-    :param symbol:
-    :param tda_bars:
-    :return:
+    :param provider: PriceProvider, opened with `async with`
+    :param symbol: stock symbol
+    :param date_from: first session date or None for all bars available
+    :param date_to: last session date
+    :param limiter: AdaptiveRateLimiter, default the shared one for the provider
+    :return: sanitized response dict
     """
-    # convert epoch from tda response to datetime field:date
-    tda_bars = [
-        dict(
-            item,
-            **{
-                "date": datetime.datetime.fromtimestamp(
-                    item["datetime"] / 1000
-                ).astimezone(pytz.UTC)
-            },
-        )
-        for item in tda_bars
-    ]
+    if limiter is None:
+        limiter = get_rate_limiter(provider.name)
 
-    # delete field datetime for each dictionary in list
-    tda_bars = [
-        {key: val for key, val in sub.items() if key != "datetime"} for sub in tda_bars
-    ]
+    date_from, date_to = exchange_window(date_from, date_to)
+    await limiter.aacquire()
+    start = time.monotonic()
+    try:
+        r = await provider.aget_price_history(symbol, date_from, date_to)
+    except Exception as e:
+        limiter.release(failed=True)
+        if is_transport_error(e):
+            raise TransportError(e) from e
+        raise
+
+    release_response(limiter, r, time.monotonic() - start)
+
+    check_response(r)
+    return sanitize_response(r)
 
+
+async def fetch_many(provider, jobs, max_in_flight=32, limiter=None):
+    """
+    Fetch prices for many symbols concurrently. At most max_in_flight requests
+    are pending at once, the limiter may allow fewer. Throttled requests are
+    retried until they succeed, other errors up to MAX_ATTEMPTS.
+
+    :param provider: PriceProvider, opened with `async with`
+    :param jobs: iterable of (symbol, date_from, date_to)
+    :param max_in_flight: number of concurrent requests
+    :param limiter: AdaptiveRateLimiter, default the shared one for the provider
+    :return: async iterator of (symbol, response dict or the exception raised)
+    """
+    if limiter is None:
+        limiter = get_rate_limiter(provider.name)
+
+    jobs = iter(jobs)
+    results = asyncio.Queue(maxsize=max_in_flight)
+    # set when the consumer stops reading, the end marker would never be taken
+    closed = False
+
+    async def worker():
+        for symbol, date_from, date_to in jobs:
+            attempts = 0
+            while True:
+                try:
+                    ans = await aget_tda_prices(
+                        provider, symbol, date_from, date_to, limiter=limiter
+                    )
+                except ThrottledError:
+                    continue
+                except ProviderError as e:
+                    attempts += 1
+                    if attempts < MAX_ATTEMPTS:
+                        continue
+                    ans = e
+                await results.put((symbol, ans))
+                break
+
+    async def run_workers():
+        tasks = [asyncio.create_task(worker()) for _ in range(max_in_flight)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # gather leaves the other workers running when one raises, they
+            # would wait forever on the full queue
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if not closed:
+                await results.put(None)
+
+    runner = asyncio.create_task(run_workers())
+    try:
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            yield item
+        # surface unexpected worker errors
+        await runner
+    finally:
+        closed = True
+        if not runner.done():
+            runner.cancel()
+
+
+def build_bar_rows(symbol, tda_bars):
+    """
+    Convert candles from a TDA response to rows matching the Bar model
+
+    :param symbol: symbol str
+    :param tda_bars: list of candle dicts
+    :return: list of dicts
+    """
     # add some field to each dictionary, to match the bar object model
     update_values = {
-        "symbol_id": symbol,
-        "provider": "TDA",
-        "interval": "EOD",
+        "symbol_id": get_symbol_dictionary().id_of(symbol),
+        "provider": PROVIDER_CODES["TDA"],
+        "interval": INTERVAL_CODES["EOD"],
         "last_updated": datetime.datetime.utcnow(),
     }
-    tda_bars = [dict(item, **update_values) for item in tda_bars]
+    # epoch from tda response to the session date, field datetime dropped
+    return [
+        dict(
+            {key: val for key, val in item.items() if key != "datetime"},
+            date=session_date(item["datetime"]),
+            **update_values,
+        )
+        for item in tda_bars
+    ]
 
-    # Convert the list of dictionaries to a list of bar objects
-    bars = [Bar(**one_bar) for one_bar in tda_bars]
 
-    # save the data
-    s.add_all(bars)
-    s.commit()
+def write_bars(s, rows, validate=True, run_id=None):
+    """
+    Save bar rows, of one or many symbols, in a single bulk insert. Rows failing
+    validation are quarantined in the same transaction. The written ranges are
+    appended to the change feed and published after the commit.
+
+    :param s: database session obj
+    :param rows: list of dicts from build_bar_rows
+    :param validate: run the data quality checks first
+    :param run_id: ingest run id for the change feed, a new one when None
+    :return: number of rows written to bars
+    """
+    quarantined = []
+    changes = []
+    if validate:
+        rows, quarantined = validate_rows(s, rows)
+    if rows or quarantined:
+        if rows:
+            s.execute(insert(Bar), rows)
+            # same transaction, readers never see bars ahead of the snapshot
+            upsert_latest_bars(s, rows)
+            update_features(s, rows)
+            changes = record_changes(s, rows, run_id or new_run_id())
+        quarantine_rows(s, quarantined)
+        s.commit()
+        get_bar_cache().invalidate_rows(rows)
+        get_change_feed().publish(changes)
+    return len(rows)
 
+
+def update_bars(s, symbol, tda_bars):
+    """
+
+    :param session:
+    :param symbol:
+    :param tda_bars:
+    :return:
+    """
+    write_bars(s, build_bar_rows(symbol, tda_bars))
     return True
 
 
@@ -213,36 +371,100 @@ def get_symbols_to_update(s, unwanted):
     :return: list of strings with symbols
     """
     # get all symbols in the database
-    symbols = s.execute(select(Symbol.id)).all()
+    symbols = s.execute(select(Symbol.symbol)).all()
     symbols = [x[0] for x in symbols]
     # remove some symbols with problems
     symbols = remove_unwanted_symbols(symbols, unwanted)
     return symbols
 
 
-def get_dates_for_update(symbol, date_to=None):
+def default_date_to(date_to=None):
+    """
+    Last session to update, at midnight as the bars are stamped
+
+    :param date_to: datetime, default the previous working day
+    :return: datetime
+    """
+    if date_to is None:
+        date_to = previous_working_day(datetime.datetime.utcnow())
+    return date_to.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_dates_for_update(s, symbol, date_to=None, last_candle_date=None):
     """
     Compute the dates for a bar update
     from last update + 1 until last working day in the U.S.
 
+    :param s: SECMASTER session
     :param symbol: symbol str
+    :param date_to: datetime, default the previous working day
+    :param last_candle_date: datetime, queried from the database when None
     :return: date_from, date_to
     """
 
-    last_candle_date = get_last_candle(session, each_symbol, "date")
+    if last_candle_date is None:
+        last_candle_date = get_last_candle(s, symbol, "date")
 
     if last_candle_date is None:
         return None, None
     else:
-        date_from = last_candle_date + timedelta(days=1)
-        if date_to is None:
-            date_to = previous_working_day(datetime.datetime.utcnow())
-        
-        date_to = date_to = date_to.replace(
-                hour=5, minute=0, second=0, microsecond=0
-            )
+        # the session of the bar, whatever hour older writers stamped it at
+        last_session = datetime.datetime(
+            last_candle_date.year, last_candle_date.month, last_candle_date.day
+        )
+        date_from = last_session + timedelta(days=1)
+        return date_from, default_date_to(date_to)
 
-        return date_from, date_to
+
+def get_update_jobs(s, symbols, date_to=None, since=None):
+    """
+    Fetch jobs for the symbols that need new bars. Symbols with to_update FALSE
+    and symbols already up to date are left out.
+
+    :param s: SECMASTER session
+    :param symbols: list of strings with symbols
+    :param date_to: datetime, default the previous working day
+    :param since: datetime, fetch nothing older. Symbols without bars get
+        their history from here instead of everything the provider has
+    :return: list of (symbol, date_from, date_to)
+    """
+    stmt = select(Symbol.symbol).where(Symbol.to_update == True)
+    active = set(x[0] for x in s.execute(stmt).all())
+    ids = get_symbol_dictionary().ids(symbols, s)
+    # one scan of the snapshot instead of a max(date) per symbol
+    last_dates = get_last_dates(s)
+    # symbols not in the snapshot, bars without one or none at all, in one
+    # grouped query rather than a lookup each
+    missing = [
+        ids[x] for x in symbols if x in active and x in ids and ids[x] not in last_dates
+    ]
+    for chunk in split_list(missing, 1000):
+        stmt = (
+            select(Bar.symbol_id, func.max(Bar.date))
+            .where(Bar.symbol_id.in_(chunk))
+            .group_by(Bar.symbol_id)
+        )
+        last_dates.update({x[0]: x[1] for x in s.execute(stmt).all()})
+    jobs = []
+    for each_symbol in symbols:
+        if each_symbol not in active:
+            continue
+        last_date = last_dates.get(ids.get(each_symbol))
+        if last_date is None:
+            # no bars yet, the whole history
+            date_from, symbol_date_to = None, None
+        else:
+            date_from, symbol_date_to = get_dates_for_update(
+                s, each_symbol, date_to, last_date
+            )
+        if since is not None and (date_from is None or date_from < since):
+            date_from = since
+            symbol_date_to = default_date_to(date_to)
+        # Only can update if dates are in the past, both are session dates
+        if date_from is not None and date_from > symbol_date_to:
+            continue
+        jobs.append((each_symbol, date_from, symbol_date_to))
+    return jobs
 
 
 def update_symbol_to_update_status(s, symbol, status):
@@ -254,67 +476,66 @@ def update_symbol_to_update_status(s, symbol, status):
     :param status: _description_
     :return: _description_
     """
-    stmt = update(Symbol).where(Symbol.id == symbol).values(to_update=status)
+    stmt = update(Symbol).where(Symbol.symbol == symbol).values(to_update=status)
     s.execute(stmt)
     s.commit()
     return True
 
 
-if __name__ == "__main__":
-    start_time = datetime.datetime.now()
+def update_market_data(
+    s,
+    provider=None,
+    unwanted=(),
+    date_to=None,
+    symbols=None,
+    since=None,
+    fetchers=32,
+    run_id=None,
+):
+    """
+    Fetch and store the missing bars of every symbol to update
 
-    date_to = datetime.datetime(day=22, month=4, year=2022)
+    :param s: SECMASTER session
+    :param provider: PriceProvider, default from Config.PRICE_PROVIDER
+    :param unwanted: list of strings with symbols not to update
+    :param date_to: datetime, default the previous working day
+    :param symbols: list of strings with symbols, default all in the database
+    :param since: datetime, fetch nothing older
+    :param fetchers: requests in flight
+    :param run_id: id in the change feed, a new one when None
+    :return: pipeline report dict
+    """
+    from secmaster.data_manager.pipeline import IngestPipeline
 
-    logger.info("Starting to update market data")
-    unwanted = ["CEI", "DCTH", "RSLS", "TOPS", "UVXY", "GMGI"]
-    session = DatabaseConnector().session()
-    tda_client = get_tda_client()
+    if provider is None:
+        provider = get_provider()
 
-    symbols = get_symbols_to_update(session, unwanted=unwanted)
-    # symbols = ["TSLA", "AAPL"]
+    jobs = get_market_data_jobs(s, unwanted, date_to, symbols, since)
+    limiter = get_rate_limiter(provider.name)
+    pipeline = IngestPipeline(
+        s, provider, limiter=limiter, fetchers=fetchers, run_id=run_id
+    )
+    report = asyncio.run(pipeline.run(jobs))
+    logger.info(f"Rate limiter: {limiter.stats()}")
+    return report
 
-    logger.info(f"Ready to update {len(symbols)} symbols")
-    counter = 0
-    for each_symbol in symbols:
-        # Only update if the symbol's to_update is TRUE
-        to_update_status = session.execute(
-            select(Symbol.to_update).where(Symbol.id == each_symbol)
-        ).first()[0]
-        if not to_update_status:
-            counter += 1
-            progressbar_print(counter, len(symbols))
-            continue
 
-        date_from, date_to = get_dates_for_update(each_symbol, date_to)
-        # Only can update if dates are in the past
-        if date_from is not None:
-            if date_from >= date_to:
-                counter += 1
-                progressbar_print(counter, len(symbols))
-                continue
-
-        response = get_tda_prices(tda_client, each_symbol, date_from, date_to)
-
-        if response["empty"] == True:
-            # if response is empty could be an old symbol, not longer trading so
-            # no need for query.
-            # Change Symbol.to_update if you need to query a symbol
-            update_symbol_to_update_status(session, each_symbol, False)
-        else:
-            update_bars(session, each_symbol, response["candles"])
+def get_market_data_jobs(s, unwanted=(), date_to=None, symbols=None, since=None):
+    """
+    The jobs update_market_data would run, without fetching anything
 
-        counter += 1
-        progressbar_print(counter, len(symbols))
+    :return: list of (symbol, date_from, date_to)
+    """
+    all_symbols = get_symbols_to_update(s, unwanted=list(unwanted))
+    if symbols is not None:
+        wanted = set(symbols)
+        all_symbols = [x for x in all_symbols if x in wanted]
+    jobs = get_update_jobs(s, all_symbols, date_to, since)
+    logger.info(f"Ready to update {len(jobs)} of {len(all_symbols)} symbols")
+    return jobs
 
-        # Do not upset TDA server
-        if counter % 10 == 0:
-            time.sleep(1)
-        elif counter % 100 == 0:
-            time.sleep(3)
-        else:
-            time.sleep(0.2)
 
-    session.close()
-    elapsed_time = datetime.datetime.now() - start_time
-    logger.info(f"Done updating data for {len(symbols)} symbols in {elapsed_time}.")
+if __name__ == "__main__":
+    from secmaster.cli import main
 
+    sys.exit(main(["eod"] + sys.argv[1:]))
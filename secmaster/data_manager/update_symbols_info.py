@@ -1,9 +1,11 @@
 import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from secmaster.common.tools import DatabaseConnector, progressbar_print
-from secmaster.data_manager.nasdaq_symbols import get_symbol_info
+from secmaster.common.tools import progressbar_print
 from secmaster.db.models import Symbol
+from secmaster.providers.base import get_provider, get_symbol_info
 from sqlalchemy import and_, exc, select, update
 
 logging.basicConfig(level=logging.INFO)
@@ -24,59 +26,75 @@ def sanitize_secmaster_to_yahoo(symbol):
     return symbol.replace("/", "-")
 
 
-def update_symbols_info(s):
+def get_symbols_without_info(s, symbols=None):
+    """
+    :param s: database session to secmaster
+    :param symbols: optional list of strings with symbols to consider
+    :return: list of strings with symbols missing sector, industry information
+    """
+    stmt = select(Symbol.symbol).where(and_(Symbol.quote_type == None))
+    if symbols is not None:
+        stmt = stmt.where(Symbol.symbol.in_(symbols))
+    return [x[0] for x in s.execute(stmt).all()]
+
+
+def update_symbols_info(s, provider=None, symbols=None, workers=1):
     """
     Update info from yahoo for symbols without sector, industry information.
+    Lookups run in a thread pool, the database is written from this thread.
+
     :param s: database session to secmaster
+    :param provider: PriceProvider, default from Config.PRICE_PROVIDER
+    :param symbols: optional list of strings with symbols to consider
+    :param workers: lookups in flight
     :return:
     """
     logger.info("update symbol info initialized.")
+    if provider is None:
+        provider = get_provider()
 
-    stmt = select(Symbol.id).where(and_(Symbol.quote_type == None))
-    query = s.execute(stmt).all()
-    symbols_to_update = [x[0] for x in query]
+    symbols_to_update = get_symbols_without_info(s, symbols)
 
     logger.info(f"Ready to update {len(symbols_to_update)} symbol's info.")
     counter = 0
-    for each_symbol in symbols_to_update:
-
+    with ThreadPoolExecutor(max_workers=workers) as pool:
         # Get the data from yahoo
-        each_symbol = sanitize_secmaster_to_yahoo(each_symbol)
-        
-        info = get_symbol_info(each_symbol)
-        if info is not None:
-            sector = (info.get("sector", None),)
-            industry = (info.get("industry", None),)
-            quote_type = (info.get("quoteType", None),)
-
-            update_symbol_stmt = (
-                update(Symbol)
-                .where(Symbol.id == each_symbol)
-                .values(
-                    industry=industry,
-                    sector=sector,
-                    quote_type=quote_type,
-                    last_updated=datetime.utcnow(),
+        infos = pool.map(
+            lambda x: get_symbol_info(sanitize_secmaster_to_yahoo(x), provider),
+            symbols_to_update,
+        )
+        for each_symbol, info in zip(symbols_to_update, infos):
+            if info is not None:
+                sector = (info.get("sector", None),)
+                industry = (info.get("industry", None),)
+                quote_type = (info.get("quoteType", None),)
+
+                update_symbol_stmt = (
+                    update(Symbol)
+                    .where(Symbol.symbol == each_symbol)
+                    .values(
+                        industry=industry,
+                        sector=sector,
+                        quote_type=quote_type,
+                        last_updated=datetime.utcnow(),
+                    )
                 )
-            )
 
-            try:
-                s.execute(update_symbol_stmt)
-                s.commit()
-            except exc.SQLAlchemyError:
-                logger.warning(f"Error updating symbol: {each_symbol}, moving on.")
-                continue
+                try:
+                    s.execute(update_symbol_stmt)
+                    s.commit()
+                except exc.SQLAlchemyError:
+                    logger.warning(f"Error updating symbol: {each_symbol}, moving on.")
+                    continue
 
-        counter += 1
-        progressbar_print(counter, len(symbols_to_update))
+            counter += 1
+            progressbar_print(counter, len(symbols_to_update))
 
     logger.info(f"Done updating {counter} symbol's info.")
     return True
 
 
 if __name__ == "__main__":
-    # database session
-    db_session = DatabaseConnector().session()
+    from secmaster.cli import main
 
-    update = update_symbols_info(db_session)
-    db_session.close()
+    sys.exit(main(["info"] + sys.argv[1:]))
@@ -0,0 +1,273 @@
+"""
+Data quality checks for fetched bars, run by the bar writer before insert.
+
+The checks are vectorized over the whole batch, every symbol at once, and
+compare the first new bar of each symbol with its stored last bar. Rows failing
+any check go to quarantined_bars with the names of the checks, the rest are
+written. A bad bar kept out of bars never needs a full history rewrite, and a
+good one held by mistake is written with release_quarantined.
+
+    missing        a price or the volume is NaN or missing
+    non_positive   a price is zero or negative
+    zero_volume    no shares traded
+    high_low       high below low
+    ohlc_range     open or close outside [low, high]
+    duplicate      same session twice in the batch
+    not_after_last session not after the stored last bar
+    spike          close moved more than MAX_MOVE from the last accepted close
+                   and from the bar before it. A new level that holds, a split
+                   say, costs only its first bar; the next one is accepted.
+"""
+import datetime
+import logging
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import delete, insert, select
+
+from secmaster.db.models import Bar, LatestBar, QuarantinedBar
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EXCHANGE_TZ = ZoneInfo("America/New_York")
+PRICE_FIELDS = ["open", "high", "low", "close"]
+# A daily close more than 50% away from the previous one is held for review
+MAX_MOVE = 0.5
+QUARANTINE_FIELDS = [
+    "symbol_id",
+    "date",
+    "open",
+    "high",
+    "low",
+    "close",
+    "volume",
+    "interval",
+    "provider",
+]
+
+
+def session_date(epoch_ms):
+    """
+    Exchange session of a daily candle. TDA stamps them at midnight Central
+    time, the same calendar day in New York, whatever the host timezone.
+
+    :param epoch_ms: candle datetime in ms since the epoch
+    :return: naive datetime, midnight of the session date
+    """
+    d = datetime.datetime.fromtimestamp(epoch_ms / 1000, tz=EXCHANGE_TZ)
+    return datetime.datetime(d.year, d.month, d.day)
+
+
+def exchange_window(date_from, date_to):
+    """
+    Fetch window of whole sessions as aware datetimes in the exchange timezone,
+    so the epochs sent to the provider do not depend on the host timezone
+
+    :param date_from: first session, naive session date or aware datetime
+    :param date_to: last session, naive session date or aware datetime
+    :return: (midnight New York starting date_from, last ms of date_to),
+        None stays None
+    """
+
+    def midnight(d):
+        if d.tzinfo is not None:
+            d = d.astimezone(EXCHANGE_TZ)
+        return datetime.datetime(d.year, d.month, d.day, tzinfo=EXCHANGE_TZ)
+
+    start = None if date_from is None else midnight(date_from)
+    end = None
+    if date_to is not None:
+        end = midnight(date_to) + datetime.timedelta(days=1, milliseconds=-1)
+    return start, end
+
+
+def get_last_bars(s, symbols):
+    """
+    :param s: database session obj
+    :param symbols: list of symbol ids
+    :return: dict symbol id -> (date, close) of the stored last bar
+    """
+    stmt = select(LatestBar.symbol_id, LatestBar.date, LatestBar.close).where(
+        LatestBar.symbol_id.in_(symbols)
+    )
+    return {x[0]: (x[1], x[2]) for x in s.execute(stmt).all()}
+
+
+def find_problems(frame, last_bars):
+    """
+    Run every check over a batch
+
+    :param frame: pandas DataFrame of bar rows sorted by symbol_id and date
+    :param last_bars: dict symbol id -> (date, close) of the stored last bar
+    :return: DataFrame of bools, one column per check, indexed like frame
+    """
+    import pandas as pd
+
+    prices = frame[PRICE_FIELDS].apply(pd.to_numeric, errors="coerce")
+    volume = pd.to_numeric(frame["volume"], errors="coerce")
+    session = pd.to_datetime(frame["date"]).dt.normalize()
+    symbol = frame["symbol_id"]
+
+    checks = pd.DataFrame(index=frame.index)
+    checks["missing"] = prices.isna().any(axis=1) | volume.isna()
+    checks["non_positive"] = (prices <= 0).any(axis=1)
+    checks["zero_volume"] = volume <= 0
+    checks["high_low"] = prices["high"] < prices["low"]
+    body = prices[["open", "close"]]
+    outside = body.lt(prices["low"], axis=0) | body.gt(prices["high"], axis=0)
+    checks["ohlc_range"] = outside.any(axis=1) & ~checks["high_low"]
+    checks["duplicate"] = pd.DataFrame({"s": symbol, "d": session}).duplicated()
+
+    last_date = pd.to_datetime(symbol.map({k: v[0] for k, v in last_bars.items()}))
+    checks["not_after_last"] = session <= last_date.dt.normalize()
+
+    # The fetch starts after the stored last bar, so the first bar of a symbol
+    # is compared with the stored close. Later ones with the last bar passing
+    # every other check (the move from the bar before) and the last of those
+    # not moved itself (the move from the last accepted bar). A spike needs
+    # both: a held level is a move from the last accepted bar only.
+    stored_close = pd.to_numeric(
+        symbol.map({k: v[1] for k, v in last_bars.items()}), errors="coerce"
+    )
+    close = prices["close"]
+    sound = ~checks.any(axis=1)
+    moved = (close / _previous(close, sound, symbol, stored_close) - 1).abs()
+    candidate = moved > MAX_MOVE
+    accepted = _previous(close, sound & ~candidate, symbol, stored_close)
+    checks["spike"] = candidate & ((close / accepted - 1).abs() > MAX_MOVE)
+    return checks
+
+
+def _previous(close, mask, symbol, stored_close):
+    """
+    :return: for each row the close of the last earlier row of its symbol
+        where mask is True, the stored close when there is none
+    """
+    prev = close.where(mask).groupby(symbol, sort=False).shift()
+    prev = prev.groupby(symbol, sort=False).ffill()
+    return prev.fillna(stored_close)
+
+
+def validate_rows(s, rows):
+    """
+    Split bar rows into the ones to write and the ones to quarantine
+
+    :param s: database session obj
+    :param rows: list of bar row dicts, any number of symbols
+    :return: (list of good row dicts sorted by symbol and date,
+        list of quarantine row dicts with their reasons)
+    """
+    if not rows:
+        return [], []
+    import pandas as pd
+
+    frame = pd.DataFrame(rows)
+    frame = frame.sort_values(["symbol_id", "date"], kind="stable")
+    last_bars = get_last_bars(s, frame["symbol_id"].unique().tolist())
+    checks = find_problems(frame, last_bars)
+
+    bad = checks.any(axis=1)
+    good = [rows[i] for i in frame.index[~bad]]
+    quarantined = []
+    for i, failed in checks[bad].iterrows():
+        row = {k: rows[i].get(k) for k in QUARANTINE_FIELDS}
+        for k in PRICE_FIELDS + ["volume"]:
+            # NaN and other text the provider sends are not numbers for the table
+            if not isinstance(row[k], (int, float)) or row[k] != row[k]:
+                row[k] = None
+        row["reasons"] = ",".join(failed.index[failed.to_numpy()])
+        quarantined.append(row)
+    return good, quarantined
+
+
+def quarantine_rows(s, rows):
+    """
+    Save rows that failed validation. A bar already in quarantine, fetched
+    again because the stored last bar did not move, is not added twice. Does
+    not commit.
+
+    :param s: database session obj
+    :param rows: list of dicts from validate_rows
+    :return: number of rows quarantined
+    """
+    if rows:
+        dates = [x["date"] for x in rows]
+        stmt = select(QuarantinedBar.symbol_id, QuarantinedBar.date).where(
+            QuarantinedBar.symbol_id.in_({x["symbol_id"] for x in rows}),
+            QuarantinedBar.date.between(min(dates), max(dates)),
+        )
+        held = {(x[0], x[1]) for x in s.execute(stmt).all()}
+        rows = [x for x in rows if (x["symbol_id"], x["date"]) not in held]
+    if rows:
+        now = datetime.datetime.utcnow()
+        s.execute(insert(QuarantinedBar), [dict(x, quarantined_at=now) for x in rows])
+        counts = {}
+        for row in rows:
+            for reason in row["reasons"].split(","):
+                counts[reason] = counts.get(reason, 0) + 1
+        logger.warning(f"Quarantined {len(rows)} bars: {counts}")
+    return len(rows)
+
+
+def get_quarantined(s, symbols=None, ids=None):
+    """
+    :param s: database session obj
+    :param symbols: optional list of symbol ids
+    :param ids: optional list of quarantined_bars ids
+    :return: list of quarantine row dicts with their id, by symbol and date
+    """
+    stmt = select(QuarantinedBar)
+    if symbols is not None:
+        stmt = stmt.where(QuarantinedBar.symbol_id.in_(symbols))
+    if ids is not None:
+        stmt = stmt.where(QuarantinedBar.id.in_(ids))
+    stmt = stmt.order_by(QuarantinedBar.symbol_id, QuarantinedBar.date)
+    columns = ["id"] + QUARANTINE_FIELDS + ["reasons", "quarantined_at"]
+    return [{k: getattr(x[0], k) for k in columns} for x in s.execute(stmt).all()]
+
+
+def release_quarantined(s, ids, run_id=None):
+    """
+    Override: write reviewed rows to bars without validation, replacing any bar
+    stored for the same session, and take them out of quarantine. Rows missing
+    a price or the volume can not be released, the features need both. Features
+    of the symbols are rebuilt, the bars may be older than their state. Commits.
+
+    :param s: database session obj
+    :param ids: list of quarantined_bars ids
+    :param run_id: ingest run id for the change feed, a new one when None
+    :return: number of bars written
+    """
+    from secmaster.data_manager.features import rebuild_features
+    from secmaster.data_manager.tda_eod import write_bars
+
+    rows = get_quarantined(s, ids=ids)
+    fields = PRICE_FIELDS + ["volume"]
+    incomplete = [x["id"] for x in rows if any(x[k] is None for k in fields)]
+    if incomplete:
+        logger.warning(f"Quarantined bars {incomplete} miss values, not released")
+    rows = [x for x in rows if x["id"] not in incomplete]
+    if not rows:
+        return 0
+
+    released = [x["id"] for x in rows]
+    s.execute(delete(QuarantinedBar).where(QuarantinedBar.id.in_(released)))
+    for row in rows:
+        stmt = delete(Bar).where(
+            Bar.symbol_id == row["symbol_id"], Bar.date == row["date"]
+        )
+        s.execute(stmt)
+    now = datetime.datetime.utcnow()
+    bars = [dict({k: x[k] for k in QUARANTINE_FIELDS}, last_updated=now) for x in rows]
+    written = write_bars(s, bars, validate=False, run_id=run_id)
+    rebuild_features(s, sorted({x["symbol_id"] for x in rows}))
+    logger.info(f"Released {written} quarantined bars")
+    return written
+
+
+if __name__ == "__main__":
+    from secmaster.common.tools import DatabaseConnector
+
+    connector = DatabaseConnector()
+    QuarantinedBar.__table__.create(connector.engine(), checkfirst=True)
+    logger.info("quarantined_bars table ready")
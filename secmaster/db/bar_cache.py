@@ -0,0 +1,423 @@
+import datetime
+import fcntl
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from sqlalchemy import func, select
+
+from secmaster.common.config import Config
+from secmaster.common.tools import to_naive_utc
+from secmaster.db.change_feed import GAP_WAIT, committed_prefix
+from secmaster.db.models import Bar, BarChange
+from secmaster.db.symbol_ids import get_symbol_dictionary
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# rough memory of one cached bar row (tuple of datetime, 4 floats and an int)
+ROW_BYTES = 200
+BAR_FIELDS = ["date", "open", "high", "low", "close", "volume"]
+# seconds between reads of bar_changes, the staleness bound of other writers
+SYNC_INTERVAL = 1.0
+# rows read per round trip when streaming a range
+BATCH_ROWS = 50000
+# longer ranges are streamed from the database every time, never cached
+MAX_CACHED_ROWS = 100000
+
+
+def _overlaps(a_from, a_to, b_from, b_to):
+    """
+    True if two date ranges intersect, None meaning open ended
+    """
+    return (a_from is None or b_to is None or a_from <= b_to) and (
+        a_to is None or b_from is None or b_from <= a_to
+    )
+
+
+class DiskTier:
+    """
+    Shared cache tier in a local directory, visible to every process on the
+    host. One sub directory per symbol, so invalidation only lists that symbol.
+    A per symbol version file lets other processes notice invalidations. Each
+    entry keeps the bar_changes seq its writer had applied when it was read.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _symbol_dir(self, symbol):
+        return Path(self.directory, hashlib.md5(str(symbol).encode()).hexdigest())
+
+    def _path(self, symbol, date_from, date_to):
+        name = f"{date_from}_{date_to}".replace(" ", "T").replace(":", "")
+        return Path(self._symbol_dir(symbol), f"{name}.pkl")
+
+    def get(self, symbol, date_from, date_to):
+        try:
+            with open(self._path(symbol, date_from, date_to), "rb") as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, symbol, date_from, date_to, rows, seq=None):
+        """
+        :param seq: bar_changes seq applied before the rows were read
+        """
+        path = self._path(symbol, date_from, date_to)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        entry = (date_from, date_to, rows, seq)
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # readers never see a half written file
+        tmp.replace(path)
+
+    def invalidate(self, symbol, date_from=None, date_to=None):
+        symbol_dir = self._symbol_dir(symbol)
+        if symbol_dir.exists():
+            for path in symbol_dir.glob("*.pkl"):
+                entry = self._read_range(path)
+                if entry is None or _overlaps(entry[0], entry[1], date_from, date_to):
+                    path.unlink(missing_ok=True)
+        self._bump(symbol)
+
+    def _read_range(self, path):
+        try:
+            with open(path, "rb") as f:
+                date_from, date_to = pickle.load(f)[:2]
+                return date_from, date_to
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def version(self, symbol):
+        try:
+            return int(Path(self._symbol_dir(symbol), "version").read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _bump(self, symbol):
+        symbol_dir = self._symbol_dir(symbol)
+        symbol_dir.mkdir(exist_ok=True)
+        # a bump lost to a concurrent one would leave another process an entry
+        # it must drop, so read and write under a lock across processes
+        with open(Path(symbol_dir, "version.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            tmp = Path(symbol_dir, f"version.{os.getpid()}.{threading.get_ident()}")
+            tmp.write_text(str(self.version(symbol) + 1))
+            # readers do not lock, they see the old or the new number
+            tmp.replace(Path(symbol_dir, "version"))
+
+
+class BarCache:
+    """
+    Read-through cache of bar range queries.
+
+    An in-process LRU bounded by memory sits in front of an optional shared
+    tier. The bar writer calls invalidate for the symbols and dates it writes,
+    which drops every overlapping range. Each symbol has a version: a read that
+    started before an invalidation is not cached, and with a shared tier other
+    processes see the version change and drop their own copies.
+
+    Writers in other processes are seen through bar_changes: sync reads the
+    changes after the last seq it applied and invalidates their ranges in both
+    tiers, so a reader is at most sync_interval behind any writer, on this host
+    or not. Shared entries are stamped with the seq their writer had applied; an
+    entry older than the first seq this process synced from may have missed
+    changes nobody on the host applied, and is not used.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, shared=None, sync_interval=SYNC_INTERVAL):
+        """
+        :param max_bytes: memory budget of the in-process tier
+        :param shared: optional DiskTier (or any object with the same methods)
+        :param sync_interval: seconds between reads of bar_changes
+        """
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_symbol = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._seq = None
+        self._first_seq = None
+        self._synced_at = None
+        self._sync_lock = threading.Lock()
+
+    def version(self, symbol):
+        """
+        Token to take before reading the database, give it back to put
+        """
+        local = self._versions.get(symbol, 0)
+        if self.shared is None:
+            return (local, 0)
+        return (local, self.shared.version(symbol))
+
+    def get(self, symbol, date_from, date_to):
+        key = (symbol, date_from, date_to)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            rows, version = entry
+            if self.shared is None or version == self.version(symbol):
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                return rows
+            self._drop(key)
+
+        if self.shared is not None:
+            entry = self.shared.get(symbol, date_from, date_to)
+            if entry is not None and self._first_seq is not None:
+                seq = entry[3] if len(entry) > 3 else None
+                if seq is None or seq < self._first_seq:
+                    entry = None
+            if entry is not None:
+                rows = entry[2]
+                self._store(key, rows, self.version(symbol))
+                with self._lock:
+                    self.hits += 1
+                return rows
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, symbol, date_from, date_to, rows, version):
+        """
+        :param version: token from version() taken before the database read
+        """
+        if version != self.version(symbol):
+            # bars for this symbol were written while we were reading
+            return False
+        self._store((symbol, date_from, date_to), rows, version)
+        if self.shared is not None:
+            self.shared.put(symbol, date_from, date_to, rows, self._seq)
+        return True
+
+    def _store(self, key, rows, version):
+        size = ROW_BYTES * len(rows) + ROW_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop_locked(key)
+            self._entries[key] = (rows, version)
+            self._by_symbol.setdefault(key[0], set()).add(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop_locked(oldest)
+
+    def _drop(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._drop_locked(key)
+
+    def _drop_locked(self, key):
+        rows, _ = self._entries.pop(key)
+        self.bytes -= ROW_BYTES * len(rows) + ROW_BYTES
+        keys = self._by_symbol.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_symbol[key[0]]
+
+    def invalidate(self, symbol, date_from=None, date_to=None, shared=True):
+        """
+        Drop the cached ranges of a symbol overlapping the written dates
+
+        :param symbol: symbol id
+        :param date_from: first date written, None for all
+        :param date_to: last date written, None for all
+        :param shared: also drop them from the shared tier
+        """
+        date_from, date_to = to_naive_utc(date_from), to_naive_utc(date_to)
+        with self._lock:
+            self._versions[symbol] = self._versions.get(symbol, 0) + 1
+            for key in list(self._by_symbol.get(symbol, ())):
+                if _overlaps(key[1], key[2], date_from, date_to):
+                    self._drop_locked(key)
+        if shared and self.shared is not None:
+            self.shared.invalidate(symbol, date_from, date_to)
+
+    def sync(self, s, force=False):
+        """
+        Invalidate the ranges written since the last sync, by any process.
+        Skipped when the last sync is younger than sync_interval, or another
+        thread is syncing.
+
+        A seq is taken at insert but seen at commit, so the position only moves
+        to the end of the committed prefix; changes after a gap are applied
+        again on the next sync.
+
+        :param s: database session obj
+        :param force: sync even if the last one is recent
+        :return: number of changes applied
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return 0
+        try:
+            now = time.monotonic()
+            if self._synced_at is not None and not force:
+                if now - self._synced_at < self.sync_interval:
+                    return 0
+            if self._seq is None:
+                # nothing cached yet, only changes that may still be committing
+                # must be looked at
+                stmt = select(func.max(BarChange.seq)).where(
+                    BarChange.created_at
+                    < datetime.datetime.utcnow() - datetime.timedelta(seconds=GAP_WAIT)
+                )
+                self._seq = s.execute(stmt).scalar() or 0
+                self._first_seq = self._seq
+
+            columns = ["seq", "symbol_id", "date_from", "date_to", "created_at"]
+            stmt = (
+                select(*[getattr(BarChange, x) for x in columns])
+                .where(BarChange.seq > self._seq)
+                .order_by(BarChange.seq)
+            )
+            changes = [dict(zip(columns, x)) for x in s.execute(stmt).all()]
+            for change in changes:
+                # the writer may be on another host or have no shared tier
+                self.invalidate(
+                    change["symbol_id"], change["date_from"], change["date_to"]
+                )
+            applied = committed_prefix(changes, self._seq)
+            if applied:
+                self._seq = applied[-1]["seq"]
+            self._synced_at = now
+            return len(changes)
+        finally:
+            self._sync_lock.release()
+
+    def invalidate_rows(self, rows):
+        """
+        Invalidate the ranges touched by bar rows of any number of symbols
+
+        :param rows: list of bar row dicts
+        """
+        ranges = {}
+        for row in rows:
+            first, last = ranges.get(row["symbol_id"], (row["date"], row["date"]))
+            ranges[row["symbol_id"]] = (min(first, row["date"]), max(last, row["date"]))
+        for symbol, (first, last) in ranges.items():
+            self.invalidate(symbol, first, last)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_bar_cache():
+    """
+    The process wide cache, sized by Config.BAR_CACHE_MB. Config.BAR_CACHE_DIR
+    adds the shared on-disk tier.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            shared = DiskTier(Config.BAR_CACHE_DIR) if Config.BAR_CACHE_DIR else None
+            _cache = BarCache(int(Config.BAR_CACHE_MB) * 2**20, shared)
+        return _cache
+
+
+def iter_bars(
+    s,
+    symbol,
+    date_from=None,
+    date_to=None,
+    cache=None,
+    batch_rows=BATCH_ROWS,
+    max_cached_rows=MAX_CACHED_ROWS,
+):
+    """
+    Bars of a symbol within a date range, through the cache, a batch at a time.
+    On a miss the rows are streamed from the database, so memory is bounded by
+    the batch plus what is kept for the cache; ranges longer than
+    max_cached_rows are not cached.
+
+    :param s: database session obj
+    :param symbol: symbol str, unknown symbols have no bars
+    :param date_from: datetime or None for the first bar
+    :param date_to: datetime or None for the last bar
+    :param cache: BarCache, default the process wide one, False to skip it
+    :param batch_rows: max rows per batch
+    :param max_cached_rows: longest range kept in the cache
+    :return: iterator of lists of (date, open, high, low, close, volume) tuples,
+        sorted by date
+    """
+    if cache is None:
+        cache = get_bar_cache()
+    date_from, date_to = to_naive_utc(date_from), to_naive_utc(date_to)
+    try:
+        symbol_id = get_symbol_dictionary().id_of(symbol, s)
+    except KeyError:
+        return
+
+    # keyed by id, the bar writer invalidates with the ids of its rows
+    if cache:
+        cache.sync(s)
+        rows = cache.get(symbol_id, date_from, date_to)
+        if rows is not None:
+            for i in range(0, len(rows), batch_rows):
+                yield rows[i : i + batch_rows]
+            return
+        version = cache.version(symbol_id)
+
+    stmt = select(*[getattr(Bar, x) for x in BAR_FIELDS]).where(
+        Bar.symbol_id == symbol_id
+    )
+    if date_from is not None:
+        stmt = stmt.where(Bar.date >= date_from)
+    if date_to is not None:
+        stmt = stmt.where(Bar.date <= date_to)
+    stmt = stmt.order_by(Bar.date).execution_options(yield_per=batch_rows)
+
+    kept = [] if cache else None
+    for partition in s.execute(stmt).partitions():
+        batch = [tuple(x) for x in partition]
+        if kept is not None:
+            kept += batch
+            if len(kept) > max_cached_rows:
+                kept = None
+        yield batch
+
+    if kept is not None:
+        cache.put(symbol_id, date_from, date_to, kept, version)
+
+
+def read_bars(s, symbol, date_from=None, date_to=None, cache=None):
+    """
+    Bars of a symbol within a date range, through the cache
+
+    :param s: database session obj
+    :param symbol: symbol str, unknown symbols have no bars
+    :param date_from: datetime or None for the first bar
+    :param date_to: datetime or None for the last bar
+    :param cache: BarCache, default the process wide one, False to skip it
+    :return: list of (date, open, high, low, close, volume) tuples sorted by date
+    """
+    return [
+        x for batch in iter_bars(s, symbol, date_from, date_to, cache) for x in batch
+    ]
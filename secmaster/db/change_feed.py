@@ -0,0 +1,289 @@
+"""
+Change data feed of the bars table.
+
+Every bar write appends one bar_changes row per symbol, in the same transaction
+as the bars: (seq, run_id, symbol, date_from, date_to, n_rows). seq only grows,
+so a consumer keeps the last seq it processed and asks for what came after.
+
+After the commit the writer publishes the changes to in-process subscribers
+and, if Config.CHANGE_FEED_DIR is set, appends them to bar_changes.jsonl there
+for consumers in other processes on the host.
+
+    feed = get_change_feed()
+    feed.subscribe(lambda changes: print(changes))
+
+    # from a cron job, only the bars written since the last run
+    consume_changes(session, handler, "state/signals.cursor")
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from sqlalchemy import select
+
+from secmaster.common.config import Config
+from secmaster.common.tools import to_naive_utc
+from secmaster.db.models import BarChange, Symbol
+from secmaster.db.symbol_ids import get_symbol_dictionary
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STREAM_FILE = "bar_changes.jsonl"
+DATE_FIELDS = ["date_from", "date_to", "created_at"]
+# A gap in seq younger than this may be a transaction not yet committed
+GAP_WAIT = 60
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def record_changes(s, rows, run_id):
+    """
+    Append the changes of a bar write. Does not commit, the caller commits
+    them with the bars. The flush assigns each change its seq.
+
+    :param s: database session obj
+    :param rows: list of bar row dicts written, any number of symbols
+    :param run_id: id of the ingest run writing them
+    :return: list of change dicts, with the symbol next to its id
+    """
+    ranges = {}
+    for row in rows:
+        date = to_naive_utc(row["date"])
+        first, last, n = ranges.get(row["symbol_id"], (date, date, 0))
+        ranges[row["symbol_id"]] = (min(first, date), max(last, date), n + 1)
+
+    now = datetime.datetime.utcnow()
+    changes = [
+        BarChange(
+            run_id=run_id,
+            symbol_id=symbol,
+            date_from=first,
+            date_to=last,
+            n_rows=n,
+            created_at=now,
+        )
+        for symbol, (first, last, n) in ranges.items()
+    ]
+    s.add_all(changes)
+    s.flush()
+    symbols = get_symbol_dictionary().symbols(ranges, s)
+    return [dict(x.as_dict(), symbol=symbols.get(x.symbol_id)) for x in changes]
+
+
+def _encode(change):
+    return json.dumps(
+        {k: v.isoformat() if k in DATE_FIELDS and v else v for k, v in change.items()}
+    )
+
+
+def _decode(line):
+    change = json.loads(line)
+    for k in DATE_FIELDS:
+        if change.get(k):
+            change[k] = datetime.datetime.fromisoformat(change[k])
+    return change
+
+
+class FileStream:
+    """
+    Changes as JSON lines in a local file. Each publish is one write on an
+    O_APPEND descriptor, so writers in several processes do not interleave
+    within a line.
+
+    Writers publish after their commit, so a lower seq can be appended after a
+    higher one; read holds back the changes after a recent gap, like the
+    database reader.
+    """
+
+    def __init__(self, directory):
+        self.path = Path(directory, STREAM_FILE)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def append(self, changes):
+        if not changes:
+            return
+        data = "".join(_encode(x) + "\n" for x in changes).encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def read(self, after=0, gap_wait=GAP_WAIT):
+        """
+        :param after: last seq already processed
+        :param gap_wait: seconds a seq gap is waited for
+        :return: list of change dicts with seq > after, by seq, up to the first
+            gap younger than gap_wait
+        """
+        changes = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # a writer is still appending this one
+                        break
+                    change = _decode(line)
+                    if change["seq"] > after:
+                        changes.append(change)
+        except FileNotFoundError:
+            return []
+        changes.sort(key=lambda x: x["seq"])
+        return committed_prefix(changes, after, gap_wait)
+
+
+class ChangeFeed:
+    """
+    In-process pub/sub of committed bar changes, optionally mirrored to a
+    FileStream
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """
+        :param callback: called with the list of change dicts of every write,
+            from the writer's thread
+        :return: callback, to unsubscribe later
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def publish(self, changes):
+        if not changes:
+            return
+        if self.stream is not None:
+            try:
+                self.stream.append(changes)
+            except OSError as e:
+                logger.error(f"Can not append to the change stream: {e}")
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            # a failing consumer must not fail the writer
+            try:
+                callback(changes)
+            except Exception:
+                logger.exception(f"Change feed subscriber {callback} failed")
+
+
+_feed = None
+_feed_lock = threading.Lock()
+
+
+def get_change_feed():
+    """
+    The process wide feed. Config.CHANGE_FEED_DIR adds the file stream.
+    """
+    global _feed
+    with _feed_lock:
+        if _feed is None:
+            directory = Config.CHANGE_FEED_DIR
+            _feed = ChangeFeed(FileStream(directory) if directory else None)
+        return _feed
+
+
+def read_changes(s, after=0, limit=None):
+    """
+    :param s: database session obj
+    :param after: last seq already processed
+    :param limit: max number of changes
+    :return: list of change dicts with seq > after, by seq, with the symbol
+    """
+    stmt = (
+        select(BarChange, Symbol.symbol)
+        .join(Symbol, Symbol.id == BarChange.symbol_id)
+        .where(BarChange.seq > after)
+        .order_by(BarChange.seq)
+    )
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return [dict(x[0].as_dict(), symbol=x[1]) for x in s.execute(stmt).all()]
+
+
+class Cursor:
+    """
+    Last seq a consumer processed, kept in a small file
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def load(self):
+        try:
+            return int(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def save(self, seq):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(str(seq))
+        tmp.replace(self.path)
+
+
+def committed_prefix(changes, after, gap_wait=GAP_WAIT):
+    """
+    seq is taken at insert but rows become visible at commit, so a lower seq
+    can show up after a higher one. Stop before a recent gap and pick it up
+    on the next read; gaps older than gap_wait are rolled back writes.
+
+    :param changes: list of change dicts by seq
+    :param after: last seq already processed
+    :return: the changes safe to process
+    """
+    now = datetime.datetime.utcnow()
+    expected = after + 1
+    for n, change in enumerate(changes):
+        if change["seq"] != expected:
+            age = (now - change["created_at"]).total_seconds()
+            if age < gap_wait:
+                return changes[:n]
+        expected = change["seq"] + 1
+    return changes
+
+
+def consume_changes(s, handler, cursor, limit=10000, gap_wait=GAP_WAIT):
+    """
+    Hand the changes after the cursor to handler, then move the cursor.
+    A handler raising leaves the cursor where it was, the same changes come
+    again on the next call.
+
+    :param s: database session obj
+    :param handler: callable receiving a list of change dicts
+    :param cursor: Cursor or path of the cursor file
+    :param limit: max changes per call
+    :param gap_wait: seconds a seq gap is waited for
+    :return: number of changes processed
+    """
+    if not isinstance(cursor, Cursor):
+        cursor = Cursor(cursor)
+    after = cursor.load()
+    changes = committed_prefix(read_changes(s, after, limit), after, gap_wait)
+    if changes:
+        handler(changes)
+        cursor.save(changes[-1]["seq"])
+    return len(changes)
+
+
+if __name__ == "__main__":
+    from secmaster.common.tools import DatabaseConnector
+
+    connector = DatabaseConnector()
+    BarChange.__table__.create(connector.engine(), checkfirst=True)
+    logger.info("bar_changes table ready")
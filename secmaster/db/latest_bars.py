@@ -0,0 +1,126 @@
+import logging
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from secmaster.common.tools import DatabaseConnector
+from secmaster.db.models import Bar, LatestBar
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# columns copied from bars to latest_bars
+SNAPSHOT_FIELDS = [
+    "open",
+    "high",
+    "low",
+    "close",
+    "volume",
+    "interval",
+    "provider",
+    "last_updated",
+]
+
+
+def latest_rows(rows):
+    """
+    Keep only the most recent row of each symbol
+
+    :param rows: list of bar row dicts, any number of symbols
+    :return: list of dicts, one per symbol
+    """
+    ans = {}
+    for row in rows:
+        current = ans.get(row["symbol_id"])
+        if current is None or row["date"] >= current["date"]:
+            ans[row["symbol_id"]] = row
+    return list(ans.values())
+
+
+def upsert_latest_bars(s, rows):
+    """
+    Move the snapshot forward for the symbols in rows. Older rows, for example a
+    backfill of past years, never replace a newer snapshot. Does not commit, so
+    the caller writes bars and snapshot in one transaction.
+
+    :param s: database session obj
+    :param rows: list of bar row dicts
+    :return: number of symbols upserted
+    """
+    rows = latest_rows(rows)
+    if not rows:
+        return 0
+
+    columns = ["symbol_id", "date"] + SNAPSHOT_FIELDS
+    values = [{k: x[k] for k in columns} for x in rows]
+    stmt = mysql_insert(LatestBar).values(values)
+    newer = stmt.inserted.date >= LatestBar.date
+    # MySQL assigns left to right, so date must be the last one compared
+    assignments = [
+        (k, func.if_(newer, stmt.inserted[k], LatestBar.__table__.c[k]))
+        for k in SNAPSHOT_FIELDS
+    ]
+    assignments.append(("date", func.greatest(stmt.inserted.date, LatestBar.date)))
+    s.execute(stmt.on_duplicate_key_update(assignments))
+    return len(rows)
+
+
+def get_last_dates(s, symbols=None):
+    """
+    Last bar date of every symbol, in one scan of the snapshot table
+
+    :param s: database session obj
+    :param symbols: optional list of symbol ids
+    :return: dict symbol id -> datetime
+    """
+    stmt = select(LatestBar.symbol_id, LatestBar.date)
+    if symbols is not None:
+        stmt = stmt.where(LatestBar.symbol_id.in_(symbols))
+    return {x[0]: x[1] for x in s.execute(stmt).all()}
+
+
+def get_latest_bars(s, symbols=None):
+    """
+    Last close, date and volume for the whole universe or some symbols
+
+    :param s: database session obj
+    :param symbols: optional list of symbol ids
+    :return: list of LatestBar obj
+    """
+    stmt = select(LatestBar)
+    if symbols is not None:
+        stmt = stmt.where(LatestBar.symbol_id.in_(symbols))
+    return [x[0] for x in s.execute(stmt).all()]
+
+
+def rebuild_latest_bars(s):
+    """
+    Recreate the snapshot from the bars table, after a migration or a manual fix
+
+    :param s: database session obj
+    :return: number of symbols in the snapshot
+    """
+    last = (
+        select(Bar.symbol_id, func.max(Bar.date).label("date"))
+        .group_by(Bar.symbol_id)
+        .subquery()
+    )
+    columns = ["symbol_id", "date"] + SNAPSHOT_FIELDS
+    source = select(*[Bar.__table__.c[x] for x in columns]).join(
+        last, (Bar.symbol_id == last.c.symbol_id) & (Bar.date == last.c.date)
+    )
+    s.execute(delete(LatestBar))
+    s.execute(insert(LatestBar).from_select(columns, source).prefix_with("IGNORE"))
+    s.commit()
+    return s.execute(select(func.count()).select_from(LatestBar)).scalar()
+
+
+if __name__ == "__main__":
+    connector = DatabaseConnector()
+    LatestBar.__table__.create(connector.engine(), checkfirst=True)
+
+    db_session = connector.session()
+    logger.info("Rebuilding latest_bars from bars")
+    n = rebuild_latest_bars(db_session)
+    logger.info(f"latest_bars has {n} symbols")
+    db_session.close()
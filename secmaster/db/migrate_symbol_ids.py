@@ -0,0 +1,343 @@
+"""
+Migrate a database with string symbol, provider and interval keys to the
+integer keys of the current models.
+
+Every existing table is renamed to <name>_old, the tables are created again
+from the models and the rows copied over, translating symbols to ids and
+provider and interval names to their codes. Rows are copied a chunk of symbols
+at a time, each chunk in its own transaction. The _old tables are kept for
+checking unless --drop-old is given.
+
+Every step done is recorded in symbol_id_migration in the transaction of the
+step, so an interrupted run is resumed by running it again. Rows whose symbol
+is not in symbols cannot be translated; they are counted first and the run
+stops unless --drop-orphans is given.
+
+    python -m secmaster.db.migrate_symbol_ids
+    python -m secmaster.db.migrate_symbol_ids --drop-orphans
+    python -m secmaster.db.migrate_symbol_ids --drop-old
+"""
+import argparse
+import datetime
+import logging
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    func,
+    inspect,
+    insert,
+    select,
+    text,
+)
+
+from secmaster.common.tools import DatabaseConnector, progressbar_print, split_list
+from secmaster.db.models import (
+    INTERVAL_CODES,
+    PROVIDER_CODES,
+    Base,
+    Interval,
+    Provider,
+    Symbol,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# parents first
+TABLES = [
+    "providers",
+    "intervals",
+    "symbols",
+    "earning_dates",
+    "bars",
+    "latest_bars",
+    "features",
+    "feature_states",
+    "quarantined_bars",
+    "bar_changes",
+]
+SYMBOLS_PER_CHUNK = 200
+DONE = "done"
+
+# steps finished, one row per step
+STATE = Table(
+    "symbol_id_migration",
+    MetaData(),
+    Column("step", String(64), primary_key=True),
+    Column("rows", Integer),
+    Column("finished_at", DateTime, default=datetime.datetime.utcnow),
+)
+
+
+def done_steps(engine):
+    """
+    :return: dict step -> rows, empty when the migration never started
+    """
+    if not inspect(engine).has_table(STATE.name):
+        return {}
+    with engine.connect() as conn:
+        return {x[0]: x[1] for x in conn.execute(select(STATE.c.step, STATE.c.rows))}
+
+
+def mark_done(conn, step, rows=0):
+    conn.execute(insert(STATE).values(step=step, rows=rows))
+
+
+def migration_stage(engine):
+    """
+    :return: "pending", "copying" once the tables are renamed until the last
+        copy, or "done"
+    """
+    steps = done_steps(engine)
+    if DONE in steps:
+        return "done"
+    inspector = inspect(engine)
+    if inspector.has_table(STATE.name) and inspector.has_table("symbols_old"):
+        return "copying"
+    if not inspector.has_table("symbols"):
+        # empty database, create_all makes the integer id tables
+        return "done"
+    columns = [x["name"] for x in inspector.get_columns("symbols")]
+    # created with integer ids, nothing to migrate
+    return "done" if "symbol" in columns else "pending"
+
+
+def table_sizes(conn, tables):
+    """
+    :return: dict table -> (rows, data bytes, index bytes), InnoDB estimates
+    """
+    stmt = text(
+        "SELECT table_name, table_rows, data_length, index_length "
+        "FROM information_schema.tables "
+        "WHERE table_schema = DATABASE() AND table_name IN :tables"
+    ).bindparams(bindparam("tables", expanding=True))
+    rows = conn.execute(stmt, {"tables": list(tables)}).all()
+    return {x[0]: (x[1], x[2], x[3]) for x in rows}
+
+
+def copy_codes(conn, old, model, codes):
+    """
+    providers and intervals: string ids to small int codes. Names not in codes
+    get the next free code.
+
+    :param old: old table, None when there was none
+    :return: dict name -> code
+    """
+    names = [] if old is None else [x[0] for x in conn.execute(select(old.c.id))]
+    ans = dict(codes)
+    for name in names:
+        if name not in ans:
+            ans[name] = max(ans.values(), default=0) + 1
+    conn.execute(insert(model), [{"id": v, "name": k} for k, v in ans.items()])
+    return ans
+
+
+def translated_select(old, new):
+    """
+    SELECT of the old table giving the columns of the new one, symbols joined
+    to their ids and providers and intervals to their codes
+
+    :return: (list of column names, select)
+    """
+    symbols = Symbol.__table__
+    providers = Provider.__table__.alias("p")
+    intervals = Interval.__table__.alias("i")
+
+    names = []
+    columns = []
+    source = old
+    for column in new.columns:
+        if new.name == "symbols" and column.name == "id":
+            # new surrogate key, autoincrement
+            continue
+        if new.name == "symbols" and column.name == "symbol":
+            names.append("symbol")
+            columns.append(old.c.id)
+            continue
+        if column.name not in old.c:
+            continue
+        names.append(column.name)
+        if column.name == "symbol_id":
+            source = source.join(symbols, symbols.c.symbol == old.c.symbol_id)
+            columns.append(symbols.c.id)
+        elif column.name == "provider":
+            source = source.outerjoin(providers, providers.c.name == old.c.provider)
+            columns.append(providers.c.id)
+        elif column.name == "interval":
+            source = source.outerjoin(intervals, intervals.c.name == old.c.interval)
+            columns.append(intervals.c.id)
+        else:
+            columns.append(old.c[column.name])
+    return names, select(*columns).select_from(source)
+
+
+def count_orphans(conn, tables):
+    """
+    Rows whose symbol_id is not in symbols, the copy would leave them out
+
+    :param tables: dict name -> table with string symbols, symbols included
+    :return: dict name -> orphan rows, tables without any left out
+    """
+    symbols = tables["symbols"]
+    ans = {}
+    for name, table in tables.items():
+        if "symbol_id" not in table.c:
+            continue
+        known = select(symbols.c.id).where(symbols.c.id == table.c.symbol_id)
+        stmt = select(func.count()).select_from(table).where(~known.exists())
+        rows = conn.execute(stmt).scalar()
+        if rows:
+            ans[name] = rows
+    return ans
+
+
+def copy_table(engine, old, new, steps):
+    """
+    Copy a table, a chunk of symbols per transaction when it has symbol_id.
+    Each chunk is recorded as done with its rows, the ones in steps are skipped.
+
+    :param steps: dict step -> rows of the steps already done
+    :return: number of rows copied, earlier runs included
+    """
+    names, source = translated_select(old, new)
+    copy = insert(new)
+    if new.name == "earning_dates":
+        # the old table allowed the same date twice, keep the first one
+        copy = copy.prefix_with("IGNORE")
+    if "symbol_id" not in old.c:
+        if new.name not in steps:
+            with engine.begin() as conn:
+                rows = conn.execute(copy.from_select(names, source)).rowcount
+                mark_done(conn, new.name, rows)
+            steps[new.name] = rows
+        return steps[new.name]
+
+    with engine.connect() as conn:
+        # sorted, so a resumed run cuts the same chunks
+        stmt = select(old.c.symbol_id).distinct().order_by(old.c.symbol_id)
+        symbols = conn.execute(stmt).scalars().all()
+    chunks = split_list(symbols, SYMBOLS_PER_CHUNK)
+    copied = 0
+    for n, chunk in enumerate(chunks):
+        step = f"{new.name}:{n}"
+        if step not in steps:
+            with engine.begin() as conn:
+                conn.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+                stmt = copy.from_select(names, source.where(old.c.symbol_id.in_(chunk)))
+                rows = conn.execute(stmt).rowcount
+                mark_done(conn, step, rows)
+            steps[step] = rows
+        copied += steps[step]
+        progressbar_print(n + 1, len(chunks), prefix=new.name)
+    return copied
+
+
+def drop_old_tables(engine):
+    old = [x for x in TABLES if inspect(engine).has_table(f"{x}_old")]
+    with engine.begin() as conn:
+        conn.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+        # children first
+        for name in reversed(old):
+            conn.execute(text(f"DROP TABLE `{name}_old`"))
+    logger.info(f"Dropped {[f'{x}_old' for x in old]}")
+
+
+def migrate(engine, drop_old=False, drop_orphans=False):
+    """
+    Run the migration, or resume an interrupted one
+
+    :param engine: SQLAlchemy engine of the SECMASTER database
+    :param drop_old: drop the _old tables once copied
+    :param drop_orphans: leave out the rows whose symbol is not in symbols
+        instead of stopping
+    :return: dict table -> rows copied
+    """
+    stage = migration_stage(engine)
+    if stage == "done":
+        logger.info("No string symbol ids in the database, nothing to do")
+        if drop_old:
+            drop_old_tables(engine)
+        return {}
+
+    suffix = "" if stage == "pending" else "_old"
+    existing = [x for x in TABLES if inspect(engine).has_table(f"{x}{suffix}")]
+    old_meta = MetaData()
+    old = {x: Table(f"{x}{suffix}", old_meta, autoload_with=engine) for x in existing}
+    with engine.connect() as conn:
+        before = table_sizes(conn, [x.name for x in old.values()])
+        orphans = count_orphans(conn, old)
+    for name, rows in orphans.items():
+        logger.warning(f"{name}: {rows} rows with a symbol_id not in symbols")
+    if orphans and not drop_orphans:
+        logger.error(
+            "The copy would leave out the orphan rows, add their symbols or run"
+            " with --drop-orphans"
+        )
+        raise SystemExit
+
+    if stage == "pending":
+        STATE.create(engine, checkfirst=True)
+        renames = ", ".join(f"`{x}` TO `{x}_old`" for x in existing)
+        with engine.begin() as conn:
+            conn.execute(text(f"RENAME TABLE {renames}"))
+        logger.info(f"Renamed {existing} to *_old")
+        old = {x: Table(f"{x}_old", old_meta, autoload_with=engine) for x in existing}
+    else:
+        logger.info("Resuming the copy to integer ids")
+
+    Base.metadata.create_all(engine, tables=[Base.metadata.tables[x] for x in TABLES])
+    steps = done_steps(engine)
+    if "codes" not in steps:
+        with engine.begin() as conn:
+            copy_codes(conn, old.get("providers"), Provider, PROVIDER_CODES)
+            copy_codes(conn, old.get("intervals"), Interval, INTERVAL_CODES)
+            mark_done(conn, "codes")
+
+    copied = {}
+    for name in existing:
+        if name in ("providers", "intervals"):
+            continue
+        copied[name] = copy_table(engine, old[name], Base.metadata.tables[name], steps)
+        logger.info(
+            f"{name}: {copied[name]} rows copied, {orphans.get(name, 0)} orphan"
+            " rows left out"
+        )
+    with engine.begin() as conn:
+        mark_done(conn, DONE, sum(copied.values()))
+
+    with engine.connect() as conn:
+        after = table_sizes(conn, existing)
+    for name in existing:
+        rows, data, index = before.get(f"{name}{suffix}", (0, 0, 0))
+        _, new_data, new_index = after.get(name, (0, 0, 0))
+        logger.info(
+            f"{name}: ~{rows} rows, data {data / 2**20:.1f} -> {new_data / 2**20:.1f}"
+            f" MB, indexes {index / 2**20:.1f} -> {new_index / 2**20:.1f} MB"
+        )
+
+    if drop_old:
+        drop_old_tables(engine)
+    return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move to integer symbol ids")
+    parser.add_argument("--drop-old", action="store_true", help="drop *_old tables")
+    parser.add_argument(
+        "--drop-orphans",
+        action="store_true",
+        help="leave out rows whose symbol is not in symbols",
+    )
+    args = parser.parse_args()
+
+    migrate(
+        DatabaseConnector().engine(),
+        drop_old=args.drop_old,
+        drop_orphans=args.drop_orphans,
+    )
@@ -11,6 +11,10 @@ from sqlalchemy import (
     Numeric,
     ForeignKey,
     BigInteger,
+    Float,
+    Index,
+    JSON,
+    SmallInteger,
 )
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.orm import declarative_base, relationship
@@ -18,10 +22,16 @@ from sqlalchemy.orm import declarative_base, relationship
 # declarative base class
 Base = declarative_base()
 
+# Small int codes of the providers and intervals tables, fixed so rows can be
+# built without a lookup. New providers and intervals get the next free code.
+PROVIDER_CODES = {"TDA": 1, "NASDAQ": 2, "YAHOO": 3}
+INTERVAL_CODES = {"EOD": 1}
+
 
 class Interval(Base):
     __tablename__ = "intervals"
-    id = Column(String(55), primary_key=True)
+    id = Column(SmallInteger, primary_key=True, autoincrement=False)
+    name = Column(String(55), unique=True, nullable=False)
     candle = relationship("Bar")
 
     def __repr__(self):
@@ -30,7 +40,8 @@ class Interval(Base):
 
 class Provider(Base):
     __tablename__ = "providers"
-    id = Column(String(255), primary_key=True)
+    id = Column(SmallInteger, primary_key=True, autoincrement=False)
+    name = Column(String(255), unique=True, nullable=False)
     last_updated = Column(DateTime, default=datetime.datetime.utcnow)
     symbols = relationship("Symbol")
     earnings = relationship("EarningDate")
@@ -42,22 +53,28 @@ class Provider(Base):
 
 class Symbol(Base):
     __tablename__ = "symbols"
-    id = Column(String(120), primary_key=True)
+    # integer surrogate key, bars and every derived table store this one
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    symbol = Column(String(120), unique=True, nullable=False)
     name = Column(String(255))
     sector = Column(String(255))
     industry = Column(String(255))
     quote_type = Column(String(255))
-    provider = Column(String(55), ForeignKey("providers.id"))
+    provider = Column(SmallInteger, ForeignKey("providers.id"))
     to_update = Column(Boolean, default=True)
     last_updated = Column(DateTime, default=datetime.datetime.utcnow)
     earnings = relationship("EarningDate")
     candles = relationship("Bar")
+    latest = relationship("LatestBar", uselist=False)
 
     def __repr__(self):
         return str({c.name: getattr(self, c.name) for c in self.__table__.columns})
 
     @hybrid_property
     def close(self):
+        # the snapshot row avoids loading every candle
+        if self.latest is not None:
+            return self.latest.close
         return self.candles[-1].close
 
     @hybrid_method
@@ -75,10 +92,14 @@ class Symbol(Base):
 
 class EarningDate(Base):
     __tablename__ = "earning_dates"
+    # "who reports between these dates" is a range scan, and the upsert key
+    __table_args__ = (
+        Index("ux_earning_dates_date_symbol", "earning_date", "symbol_id", unique=True),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
-    symbol_id = Column(String(55), ForeignKey("symbols.id"))
+    symbol_id = Column(Integer, ForeignKey("symbols.id"))
     earning_date = Column(DateTime)
-    provider = Column(String(55), ForeignKey("providers.id"))
+    provider = Column(SmallInteger, ForeignKey("providers.id"))
     last_updated = Column(DateTime, default=datetime.datetime.utcnow)
 
     def __repr__(self):
@@ -87,16 +108,17 @@ class EarningDate(Base):
 
 class Bar(Base):
     __tablename__ = "bars"
+    __table_args__ = (Index("ix_bars_symbol_id_date", "symbol_id", "date"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
-    symbol_id = Column(String(55), ForeignKey("symbols.id"))
+    symbol_id = Column(Integer, ForeignKey("symbols.id"))
     date = Column(DateTime)
     open = Column(Numeric(asdecimal=False, precision=12, scale=4))
     high = Column(Numeric(asdecimal=False, precision=12, scale=4))
     low = Column(Numeric(asdecimal=False, precision=12, scale=4))
     close = Column(Numeric(asdecimal=False, precision=12, scale=4))
     volume = Column(BigInteger)
-    interval = Column(String(55), ForeignKey("intervals.id"))
-    provider = Column(String(55), ForeignKey("providers.id"))
+    interval = Column(SmallInteger, ForeignKey("intervals.id"))
+    provider = Column(SmallInteger, ForeignKey("providers.id"))
     last_updated = Column(DateTime, default=datetime.datetime.utcnow)
 
     def __repr__(self):
@@ -117,3 +139,114 @@ class Bar(Base):
 
     def as_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class LatestBar(Base):
+    """
+    Snapshot of the most recent bar of each symbol, kept by the bar writer
+    """
+
+    __tablename__ = "latest_bars"
+    symbol_id = Column(Integer, ForeignKey("symbols.id"), primary_key=True)
+    date = Column(DateTime)
+    open = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    high = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    low = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    close = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    volume = Column(BigInteger)
+    interval = Column(SmallInteger, ForeignKey("intervals.id"))
+    provider = Column(SmallInteger, ForeignKey("providers.id"))
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return str({c.name: getattr(self, c.name) for c in self.__table__.columns})
+
+    def as_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class Feature(Base):
+    """
+    Rolling indicators for each bar, see data_manager/features.py
+    """
+
+    __tablename__ = "features"
+    symbol_id = Column(Integer, ForeignKey("symbols.id"), primary_key=True)
+    date = Column(DateTime, primary_key=True)
+    ret_1d = Column(Float)
+    sma_20 = Column(Float)
+    sma_50 = Column(Float)
+    sma_200 = Column(Float)
+    atr_14 = Column(Float)
+    adv_20 = Column(Float)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return str({c.name: getattr(self, c.name) for c in self.__table__.columns})
+
+    def as_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class FeatureState(Base):
+    """
+    Rolling windows of each symbol, so a new bar updates its features in O(1)
+    """
+
+    __tablename__ = "feature_states"
+    symbol_id = Column(Integer, ForeignKey("symbols.id"), primary_key=True)
+    date = Column(DateTime)
+    state = Column(JSON)
+    last_updated = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return str({c.name: getattr(self, c.name) for c in self.__table__.columns})
+
+
+class QuarantinedBar(Base):
+    """
+    Fetched bars that failed validation, kept out of bars for review.
+    See data_manager/validation.py for the reasons.
+    """
+
+    __tablename__ = "quarantined_bars"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    symbol_id = Column(Integer, ForeignKey("symbols.id"), index=True)
+    date = Column(DateTime)
+    open = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    high = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    low = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    close = Column(Numeric(asdecimal=False, precision=12, scale=4))
+    volume = Column(BigInteger)
+    interval = Column(SmallInteger, ForeignKey("intervals.id"))
+    provider = Column(SmallInteger, ForeignKey("providers.id"))
+    reasons = Column(String(255))
+    quarantined_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return str({c.name: getattr(self, c.name) for c in self.__table__.columns})
+
+    def as_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+
+class BarChange(Base):
+    """
+    Append-only log of bar writes, one row per symbol and write, in seq order.
+    See db/change_feed.py
+    """
+
+    __tablename__ = "bar_changes"
+    seq = Column(BigInteger, primary_key=True, autoincrement=True)
+    run_id = Column(String(32), index=True)
+    symbol_id = Column(Integer, ForeignKey("symbols.id"))
+    date_from = Column(DateTime)
+    date_to = Column(DateTime)
+    n_rows = Column(Integer)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return str({c.name: getattr(self, c.name) for c in self.__table__.columns})
+
+    def as_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -0,0 +1,129 @@
+"""
+Move the bars stamped by older writers to the session midnight the current
+writers use.
+
+Older writers stamped a bar with the UTC instant of the session midnight, some
+hours after midnight depending on the host, while bars are now stored at the
+naive session date. Both stamps of the same session end up side by side. Every
+row with a time part is set to its date and, where a session is then stored
+twice, the row written last is kept.
+
+Runs a chunk of symbols at a time, each chunk in its own transaction with the
+features of its symbols rebuilt and a bar_changes row per symbol, so caches and
+change feed consumers see the rewrite. Only symbols with stamps left are read,
+an interrupted run is resumed by running it again. latest_bars is rebuilt at
+the end.
+
+    python -m secmaster.db.normalize_bar_dates
+"""
+import logging
+
+from sqlalchemy import delete, func, select, update
+
+from secmaster.common.tools import DatabaseConnector, progressbar_print, split_list
+from secmaster.db.change_feed import new_run_id
+from secmaster.db.latest_bars import rebuild_latest_bars
+from secmaster.db.models import Bar, BarChange, QuarantinedBar
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SYMBOLS_PER_CHUNK = 200
+MIDNIGHT = "00:00:00"
+
+
+def stamped_symbols(s, table):
+    """
+    :return: list of symbol ids with rows not at midnight
+    """
+    stmt = select(table.c.symbol_id).where(func.time(table.c.date) != MIDNIGHT)
+    return s.execute(stmt.distinct()).scalars().all()
+
+
+def normalize_chunk(s, table, symbols):
+    """
+    Set the rows of the symbols to their date and drop the sessions stored
+    twice, keeping the highest id. Does not commit.
+
+    :return: (dict symbol id -> (first, last, rows moved), rows deleted)
+    """
+    stamped = func.time(table.c.date) != MIDNIGHT
+    stmt = (
+        select(
+            table.c.symbol_id,
+            func.min(table.c.date),
+            func.max(table.c.date),
+            func.count(),
+        )
+        .where(table.c.symbol_id.in_(symbols), stamped)
+        .group_by(table.c.symbol_id)
+    )
+    ranges = {x[0]: (x[1], x[2], x[3]) for x in s.execute(stmt).all()}
+
+    s.execute(
+        update(table)
+        .where(table.c.symbol_id.in_(symbols), stamped)
+        .values(date=func.date(table.c.date))
+    )
+    newer = table.alias("newer")
+    deleted = s.execute(
+        delete(table).where(
+            table.c.symbol_id.in_(symbols),
+            newer.c.symbol_id == table.c.symbol_id,
+            newer.c.date == table.c.date,
+            newer.c.id > table.c.id,
+        )
+    ).rowcount
+    return ranges, deleted
+
+
+def normalize(s):
+    """
+    :param s: database session obj
+    :return: dict table -> (rows moved, rows deleted)
+    """
+    from secmaster.data_manager.features import rebuild_features
+    from secmaster.db.bar_cache import get_bar_cache
+
+    ans = {}
+    for model in (QuarantinedBar, Bar):
+        table = model.__table__
+        symbols = stamped_symbols(s, table)
+        logger.info(f"{table.name}: {len(symbols)} symbols with stamped rows")
+        chunks = split_list(symbols, SYMBOLS_PER_CHUNK)
+        run_id = new_run_id()
+        moved = deleted = 0
+        for n, chunk in enumerate(chunks):
+            ranges, chunk_deleted = normalize_chunk(s, table, chunk)
+            moved += sum(x[2] for x in ranges.values())
+            deleted += chunk_deleted
+            if model is Bar:
+                rebuild_features(s, chunk, commit=False)
+                s.add_all(
+                    BarChange(
+                        run_id=run_id,
+                        symbol_id=symbol,
+                        date_from=first.replace(hour=0, minute=0, second=0),
+                        date_to=last,
+                        n_rows=rows,
+                    )
+                    for symbol, (first, last, rows) in ranges.items()
+                )
+            s.commit()
+            if model is Bar:
+                # the local tiers of other processes follow bar_changes
+                for symbol, (first, last, _) in ranges.items():
+                    get_bar_cache().invalidate(symbol, first, last)
+            progressbar_print(n + 1, len(chunks), prefix=table.name)
+        logger.info(f"{table.name}: {moved} rows moved, {deleted} duplicates deleted")
+        ans[table.name] = (moved, deleted)
+
+    n = rebuild_latest_bars(s)
+    logger.info(f"latest_bars rebuilt, {n} symbols")
+    return ans
+
+
+if __name__ == "__main__":
+    db_session = DatabaseConnector().session()
+    normalize(db_session)
+    db_session.close()
@@ -2,8 +2,8 @@ import logging
 
 from sqlalchemy.exc import SQLAlchemyError
 
-from common.tools import DatabaseConnector
-from db.models import Provider, Interval
+from secmaster.common.tools import DatabaseConnector
+from secmaster.db.models import INTERVAL_CODES, PROVIDER_CODES, Interval, Provider
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -11,12 +11,10 @@ logger.setLevel(logging.INFO)
 
 
 logger.info("Starting Securities Master database initialization.")
-s = DatabaseConnector(db_name="SECMASTER").session()
+s = DatabaseConnector().session()
 try:
-    to_add = [
-        Provider(id="TDA"),
-        Interval(id="EOD"),
-    ]
+    to_add = [Provider(id=code, name=name) for name, code in PROVIDER_CODES.items()]
+    to_add += [Interval(id=code, name=name) for name, code in INTERVAL_CODES.items()]
     s.add_all(to_add)
     s.commit()
     s.close()
@@ -0,0 +1,127 @@
+import contextlib
+import logging
+import threading
+
+from sqlalchemy import select
+
+from secmaster.common.tools import DatabaseConnector, split_list
+from secmaster.db.models import Symbol
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class SymbolDictionary:
+    """
+    In-process symbol <-> id map. Bars and the derived tables store the integer
+    id, providers, the CLI and the price service speak symbols. The first use
+    loads the whole symbols table in one query, later misses ask for just the
+    missing symbols. Ids are never reused, so entries do not go stale.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._symbols = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _session(self, s):
+        if s is not None:
+            yield s
+            return
+        s = DatabaseConnector().session()
+        try:
+            yield s
+        finally:
+            s.close()
+
+    def _remember(self, pairs):
+        with self._lock:
+            for symbol_id, symbol in pairs:
+                self._ids[symbol] = symbol_id
+                self._symbols[symbol_id] = symbol
+
+    def load(self, s=None):
+        """
+        Read every symbol once
+
+        :param s: database session obj, a short lived one when None
+        """
+        with self._session(s) as s:
+            self._remember(s.execute(select(Symbol.id, Symbol.symbol)).all())
+        self._loaded = True
+        logger.debug(f"Symbol dictionary loaded, {len(self._ids)} symbols")
+
+    def ids(self, symbols, s=None):
+        """
+        :param symbols: iterable of strings with symbols
+        :param s: database session obj, used on misses
+        :return: dict symbol -> id, unknown symbols left out
+        """
+        if not self._loaded:
+            self.load(s)
+        symbols = list(symbols)
+        missing = [x for x in symbols if x not in self._ids]
+        if missing:
+            with self._session(s) as s:
+                for chunk in split_list(missing, 1000):
+                    stmt = select(Symbol.id, Symbol.symbol).where(
+                        Symbol.symbol.in_(chunk)
+                    )
+                    self._remember(s.execute(stmt).all())
+        return {x: self._ids[x] for x in symbols if x in self._ids}
+
+    def symbols(self, symbol_ids, s=None):
+        """
+        :param symbol_ids: iterable of ints
+        :param s: database session obj, used on misses
+        :return: dict id -> symbol, unknown ids left out
+        """
+        if not self._loaded:
+            self.load(s)
+        symbol_ids = list(symbol_ids)
+        missing = [x for x in symbol_ids if x not in self._symbols]
+        if missing:
+            with self._session(s) as s:
+                for chunk in split_list(missing, 1000):
+                    stmt = select(Symbol.id, Symbol.symbol).where(Symbol.id.in_(chunk))
+                    self._remember(s.execute(stmt).all())
+        return {x: self._symbols[x] for x in symbol_ids if x in self._symbols}
+
+    def id_of(self, symbol, s=None):
+        """
+        :raise KeyError: the symbol is not in the symbols table
+        """
+        ans = self._ids.get(symbol)
+        if ans is None:
+            ans = self.ids([symbol], s).get(symbol)
+        if ans is None:
+            raise KeyError(symbol)
+        return ans
+
+    def symbol_of(self, symbol_id, s=None):
+        """
+        :raise KeyError: no symbol has this id
+        """
+        ans = self._symbols.get(symbol_id)
+        if ans is None:
+            ans = self.symbols([symbol_id], s).get(symbol_id)
+        if ans is None:
+            raise KeyError(symbol_id)
+        return ans
+
+
+_dictionary = None
+_dictionary_lock = threading.Lock()
+
+
+def get_symbol_dictionary():
+    """
+    The process wide dictionary
+    """
+    global _dictionary
+    with _dictionary_lock:
+        if _dictionary is None:
+            _dictionary = SymbolDictionary()
+        return _dictionary
@@ -0,0 +1,108 @@
+from abc import ABC, abstractmethod
+
+
+class PriceProvider(ABC):
+    """
+    Interface every market data provider must implement. A provider missing a
+    method fails when it is created, not halfway through a run.
+
+    The fetch pipeline only talks to this interface, so the live TDA/Yahoo
+    provider and the offline stub are interchangeable. Async callers open the
+    provider with `async with provider:` so it can keep a connection pool.
+    """
+
+    name = None
+
+    @abstractmethod
+    def get_price_history(self, symbol, date_from=None, date_to=None):
+        """
+        Daily candles for a symbol. All available history if date_from is None.
+
+        :param symbol: symbol str
+        :param date_from: datetime or None
+        :param date_to: datetime or None
+        :return: response object with status_code, headers, json() and raise_for_status()
+        """
+
+    async def aget_price_history(self, symbol, date_from=None, date_to=None):
+        """
+        Async get_price_history. By default the blocking call runs in a thread.
+        """
+        import asyncio
+
+        return await asyncio.to_thread(
+            self.get_price_history, symbol, date_from, date_to
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return None
+
+    @abstractmethod
+    def get_symbol_info(self, symbol):
+        """
+        Descriptive info for a symbol (sector, industry, quoteType...)
+
+        :param symbol: symbol str
+        :return: dict or None if the provider does not know the symbol
+        """
+
+    @abstractmethod
+    def get_earnings_dates(self, symbol):
+        """
+        Past and announced earnings dates of a symbol
+
+        :param symbol: symbol str
+        :return: list of naive datetimes at midnight, or None if the provider
+            does not know the symbol
+        """
+
+
+def get_provider(name=None, **kwargs):
+    """
+    Provider factory. Heavy provider modules are imported only when requested.
+
+    :param name: "TDA" or "STUB", defaults to Config.PRICE_PROVIDER
+    :param kwargs: passed to the provider constructor
+    :return: PriceProvider
+    """
+    from secmaster.common.config import Config
+
+    name = (name or Config.PRICE_PROVIDER or "TDA").upper()
+    if name == "TDA":
+        from secmaster.providers.tda import TDAProvider
+
+        return TDAProvider(**kwargs)
+    if name == "STUB":
+        from secmaster.providers.stub import StubProvider
+
+        return StubProvider(**kwargs)
+    raise ValueError(f"Unknown provider: {name}")
+
+
+def get_symbol_info(symbol, provider=None):
+    """
+    Symbol info (sector, industry, quoteType...) from the configured provider
+
+    :param symbol: symbol str
+    :param provider: PriceProvider, default from Config.PRICE_PROVIDER
+    :return: dict or None
+    """
+    if provider is None:
+        provider = get_provider()
+    return provider.get_symbol_info(symbol)
+
+
+def get_earnings_dates(symbol, provider=None):
+    """
+    Earnings dates from the configured provider
+
+    :param symbol: symbol str
+    :param provider: PriceProvider, default from Config.PRICE_PROVIDER
+    :return: list of datetimes or None
+    """
+    if provider is None:
+        provider = get_provider()
+    return provider.get_earnings_dates(symbol)
@@ -0,0 +1,271 @@
+import datetime
+import logging
+import sys
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """
+    Provider answered with an unexpected status code
+    """
+
+    def __init__(self, status_code, message=""):
+        self.status_code = status_code
+        super().__init__(f"HTTP {status_code} {message}".strip())
+
+
+class ThrottledError(ProviderError):
+    """
+    Provider answered 429, the request must be requeued after retry_after seconds
+    """
+
+    def __init__(self, retry_after=None):
+        self.retry_after = retry_after
+        super().__init__(429, f"retry after {retry_after}s")
+
+
+class TransportError(ProviderError):
+    """
+    The request never got an answer: connection refused or reset, timeout.
+    Retried like a server error.
+    """
+
+    def __init__(self, error):
+        self.error = error
+        self.status_code = None
+        Exception.__init__(self, f"{type(error).__name__}: {error}")
+
+
+def is_transport_error(e):
+    """
+    :param e: exception raised by a provider call
+    :return: True for network failures, worth another attempt
+    """
+    if isinstance(e, (OSError, TimeoutError)):
+        return True
+    # httpx errors can only come from a loaded httpx, importing it costs startup
+    httpx = sys.modules.get("httpx")
+    return httpx is not None and isinstance(e, httpx.TransportError)
+
+
+def parse_retry_after(headers, default=None):
+    """
+    Retry-After header as seconds. The header can be seconds or an HTTP date.
+
+    :param headers: response headers mapping
+    :param default: returned if the header is missing or unreadable
+    :return: float seconds or default
+    """
+    value = headers.get("Retry-After") if headers else None
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # HTTP date form, rare enough to import the parser only here
+    from email.utils import parsedate_to_datetime
+
+    try:
+        when = parsedate_to_datetime(value)
+        now = datetime.datetime.now(when.tzinfo)
+        return max(0.0, (when - now).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+def check_response(r):
+    """
+    Raise ThrottledError on 429 and ProviderError on any other non 200 response
+
+    :param r: provider response
+    :return: the response
+    """
+    if r.status_code == 200:
+        return r
+    if r.status_code == 429:
+        raise ThrottledError(parse_retry_after(r.headers))
+    raise ProviderError(r.status_code)
+
+
+class AdaptiveRateLimiter:
+    """
+    AIMD limiter for one provider.
+
+    Like TCP, it starts in slow start: every success adds one request per second,
+    doubling the rate each second, until the first throttle. From then on every
+    success adds a little to the request rate and, once per window of
+    successes, one slot of concurrency. A 429 halves both and blocks all callers
+    for Retry-After seconds. Responses slower than target_latency trim the rate,
+    so the limiter settles just under what the provider sustains. Server and
+    network errors trim the rate the same way, they never count as successes.
+    """
+
+    def __init__(
+        self,
+        name,
+        rate=5.0,
+        min_rate=0.2,
+        max_rate=100.0,
+        concurrency=2,
+        max_concurrency=32,
+        increase=5.0,
+        decrease=0.5,
+        target_latency=2.0,
+        default_retry_after=5.0,
+    ):
+        """
+        :param name: provider name, for logging
+        :param rate: starting requests per second
+        :param min_rate: the rate never goes below this
+        :param max_rate: the rate never goes above this
+        :param concurrency: starting requests in flight
+        :param max_concurrency: requests in flight never go above this
+        :param increase: requests per second added for each second of success.
+            At 1.0 a halving from 40/s took 20s to win back, four times the
+            default cool down; at 5.0 it takes about as long as the cool down.
+        :param decrease: multiplicative factor applied on throttling
+        :param target_latency: seconds, slower responses reduce the rate
+        :param default_retry_after: cool down when a 429 has no Retry-After header
+        """
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.default_retry_after = default_retry_after
+
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self.successes = 0
+        self.throttled = 0
+        self.slow_start = True
+        self._next_slot = 0.0
+        self._window_successes = 0
+        self._cond = threading.Condition()
+
+    def _try_acquire(self):
+        """
+        Take a slot if available.
+
+        :return: 0 if acquired, otherwise seconds to wait before trying again
+        """
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= self.concurrency:
+            # woken up by release
+            return None
+        if now < self._next_slot:
+            return self._next_slot - now
+        self._next_slot = max(now, self._next_slot) + 1.0 / self.rate
+        self.in_flight += 1
+        return 0
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return
+                self._cond.wait(wait)
+
+    async def aacquire(self):
+        import asyncio
+
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+            if wait == 0:
+                return
+            # concurrency is full, poll at the pace of the current rate
+            await asyncio.sleep(wait if wait is not None else 1.0 / self.rate)
+
+    def release(self, latency=None, throttled=False, retry_after=None, failed=False):
+        """
+        Give back a slot and adapt rate and concurrency to the outcome. Only a
+        200 (success) and a 429 (throttled) move the AIMD state.
+
+        :param latency: seconds the request took
+        :param throttled: True if the provider answered 429
+        :param retry_after: seconds from the Retry-After header
+        :param failed: True on any other error, a 5xx or no answer at all
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self._on_throttle(retry_after)
+            elif failed or (latency is not None and latency > self.target_latency):
+                self._trim()
+            else:
+                self._on_success()
+            self._cond.notify_all()
+
+    def _trim(self):
+        self.rate = max(self.min_rate, self.rate * (1 - (1 - self.decrease) / 4))
+
+    def _on_throttle(self, retry_after):
+        self.throttled += 1
+        if retry_after is None:
+            retry_after = self.default_retry_after
+        now = time.monotonic()
+        # several requests in flight may be throttled at once, back off only once
+        if now >= self.blocked_until:
+            self.slow_start = False
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.concurrency = max(1, int(self.concurrency * self.decrease))
+            self._window_successes = 0
+            logger.info(
+                f"{self.name} throttled, rate {self.rate:.2f}/s, "
+                f"concurrency {self.concurrency}, cool down {retry_after:.1f}s"
+            )
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self._next_slot = self.blocked_until
+
+    def _on_success(self):
+        self.successes += 1
+        if self.slow_start:
+            self.rate = min(self.max_rate, self.rate + 1.0)
+        else:
+            # additive increase: about `increase` requests/s more per second of success
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+        self._window_successes += 1
+        if self._window_successes >= self.concurrency:
+            self._window_successes = 0
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def stats(self):
+        return {
+            "provider": self.name,
+            "rate": round(self.rate, 2),
+            "concurrency": self.concurrency,
+            "slow_start": self.slow_start,
+            "successes": self.successes,
+            "throttled": self.throttled,
+        }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name, **kwargs):
+    """
+    One shared limiter per provider name in the process
+
+    :param name: provider name
+    :param kwargs: AdaptiveRateLimiter parameters, used only on creation
+    :return: AdaptiveRateLimiter
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveRateLimiter(name, **kwargs)
+        return _limiters[name]
@@ -0,0 +1,315 @@
+import asyncio
+import datetime
+import functools
+import math
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from zoneinfo import ZoneInfo
+
+from secmaster.providers.base import PriceProvider
+
+# TDA daily candles are stamped at midnight Chicago time
+CANDLE_TZ = ZoneInfo("America/Chicago")
+# Stub prices exist from this date on
+HISTORY_START = datetime.date(2000, 1, 3)
+MASK64 = (1 << 64) - 1
+# Stub earnings dates: four a year, this many years back and one quarter ahead
+EARNINGS_YEARS = 3
+NAN_FIELDS = ["open", "high", "low", "close", "volume"]
+
+SECTORS = {
+    "Technology": ["Software—Application", "Semiconductors", "Consumer Electronics"],
+    "Healthcare": ["Biotechnology", "Medical Devices", "Drug Manufacturers—General"],
+    "Financial Services": ["Banks—Regional", "Asset Management", "Insurance—Diversified"],
+    "Energy": ["Oil & Gas E&P", "Oil & Gas Midstream"],
+    "Consumer Cyclical": ["Specialty Retail", "Auto Manufacturers", "Restaurants"],
+    "Industrials": ["Aerospace & Defense", "Railroads", "Specialty Industrial Machinery"],
+}
+
+
+def _unit(key, t, k):
+    """
+    Uniform [0, 1) from (key, t, k), splitmix64 finalizer. uint64 arithmetic
+    wraps, as the 64 bit mask would.
+
+    :param t: numpy int64 array of days
+    :return: numpy float64 array
+    """
+    import numpy as np
+
+    u64 = np.uint64
+    x = (
+        u64(key)
+        + t.astype(u64) * u64(0x9E3779B97F4A7C15)
+        + u64(k * 0xD1B54A32D192ED03 & MASK64)
+    )
+    x = (x ^ (x >> u64(30))) * u64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> u64(27))) * u64(0x94D049BB133111EB)
+    return (x ^ (x >> u64(31))).astype(np.float64) / 2.0**64
+
+
+@functools.lru_cache(maxsize=None)
+def _midnight_ms(ordinal):
+    """
+    Epoch ms of midnight Chicago of a day, shared by every symbol
+    """
+    day = datetime.date.fromordinal(ordinal)
+    midnight = datetime.datetime(day.year, day.month, day.day, tzinfo=CANDLE_TZ)
+    return int(midnight.timestamp() * 1000)
+
+
+class StubHTTPError(Exception):
+    def __init__(self, response):
+        self.response = response
+        super().__init__(f"HTTP {response.status_code}")
+
+
+class StubResponse:
+    """
+    Minimal stand-in for an httpx response
+    """
+
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise StubHTTPError(self)
+
+
+class StubProvider(PriceProvider):
+    """
+    Offline provider generating realistic candle payloads, for load testing the
+    fetch pipeline without a TDA token or network access.
+
+    Prices are seeded per symbol, so the same symbol always returns the same
+    history. Failures are drawn at random on every call.
+    """
+
+    name = "STUB"
+
+    def __init__(
+        self,
+        latency=0.0,
+        latency_jitter=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        nan_rate=0.0,
+        empty_rate=0.0,
+        max_rps=None,
+        retry_after=1,
+        seed=0,
+    ):
+        """
+        :param latency: mean seconds per request
+        :param latency_jitter: +/- uniform seconds added to latency
+        :param error_rate: probability of a 500 response
+        :param throttle_rate: probability of a 429 response
+        :param nan_rate: probability of a candle with "NaN" fields
+        :param empty_rate: probability a symbol has no data (delisted)
+        :param max_rps: answer 429 when more requests than this arrive in one second
+        :param retry_after: seconds sent in the Retry-After header of a 429
+        :param seed: seed for prices and failures
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.nan_rate = nan_rate
+        self.empty_rate = empty_rate
+        self.max_rps = max_rps
+        self.retry_after = retry_after
+        self.seed = seed
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = deque()
+        self.calls = 0
+
+    def _symbol_rng(self, symbol):
+        return random.Random(zlib.crc32(symbol.encode()) ^ self.seed)
+
+    def _draw(self):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency
+            if self.latency_jitter:
+                delay += self._rng.uniform(-self.latency_jitter, self.latency_jitter)
+            return max(0.0, delay), self._rng.random(), self._rng.random()
+
+    def _over_rate(self):
+        if self.max_rps is None:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            while self._window and now - self._window[0] > 1.0:
+                self._window.popleft()
+            if len(self._window) >= self.max_rps:
+                return True
+            self._window.append(now)
+            return False
+
+    def _failure(self, throttle_draw, error_draw):
+        """
+        :return: StubResponse of the failure drawn, or None
+        """
+        if self._over_rate() or throttle_draw < self.throttle_rate:
+            return StubResponse(
+                429,
+                {"error": "Too Many Requests"},
+                {"Retry-After": str(self.retry_after)},
+            )
+        if error_draw < self.error_rate:
+            return StubResponse(500, {"error": "Internal Server Error"})
+        return None
+
+    def _ok(self, symbol, candles):
+        return StubResponse(
+            200, {"candles": candles, "symbol": symbol, "empty": len(candles) == 0}
+        )
+
+    def get_price_history(self, symbol, date_from=None, date_to=None):
+        delay, throttle_draw, error_draw = self._draw()
+        time.sleep(delay)
+        failure = self._failure(throttle_draw, error_draw)
+        if failure is not None:
+            return failure
+        return self._ok(symbol, self.make_candles(symbol, date_from, date_to))
+
+    async def aget_price_history(self, symbol, date_from=None, date_to=None):
+        delay, throttle_draw, error_draw = self._draw()
+        await asyncio.sleep(delay)
+        failure = self._failure(throttle_draw, error_draw)
+        if failure is not None:
+            return failure
+        # CPU work, on the loop it would delay every other request in flight
+        candles = await asyncio.to_thread(self.make_candles, symbol, date_from, date_to)
+        return self._ok(symbol, candles)
+
+    def make_candles(self, symbol, date_from=None, date_to=None):
+        """
+        Business day candles in TDA format.
+
+        Prices are a trend plus a few slow cycles plus daily noise, all derived
+        from (symbol, day) by hashing, so any date range costs only its own days
+        and always returns the same candles.
+
+        :param symbol: symbol str
+        :param date_from: datetime or None for twenty years of history
+        :param date_to: datetime or None for today
+        :return: list of candle dicts
+        """
+        import numpy as np
+
+        rng = self._symbol_rng(symbol)
+        if rng.random() < self.empty_rate:
+            return []
+        key = rng.getrandbits(64)
+        log_base = rng.uniform(1.0, 6.0)
+        drift = rng.uniform(-0.0001, 0.0003)
+        vol = rng.uniform(0.01, 0.03)
+        cycles = [
+            (rng.uniform(0.05, 0.4), 2 * math.pi / rng.uniform(60, 1500), rng.uniform(0, 6.3))
+            for _ in range(3)
+        ]
+        base_volume = int(math.exp(rng.uniform(10.0, 16.0)))
+
+        def log_close(t):
+            cycle = sum(a * np.sin(w * t + phase) for a, w, phase in cycles)
+            return log_base + drift * t + cycle + vol * (_unit(key, t, 0) - 0.5) * 2
+
+        end = (date_to or datetime.datetime.utcnow()).date()
+        if date_from is None:
+            day = end - datetime.timedelta(days=365 * 20)
+        else:
+            day = date_from.date()
+        day = max(day, HISTORY_START)
+        if day > end:
+            return []
+
+        # business days only, weekends have no noise draw
+        ordinals = np.arange(day.toordinal(), end.toordinal() + 1)
+        ordinals = ordinals[(ordinals + 6) % 7 < 5]
+        if len(ordinals) == 0:
+            return []
+        t = ordinals - HISTORY_START.toordinal()
+        # the close before the first one is the previous business day's
+        first = datetime.date.fromordinal(int(ordinals[0]))
+        before = t[:1] - (3 if first.weekday() == 0 else 1)
+        log_closes = log_close(np.concatenate([before, t]))
+        closes = np.exp(log_closes[1:])
+        prev_closes = np.exp(log_closes[:-1])
+
+        # five 12 bit draws out of one hash
+        bits = (_unit(key, t, 1) * 2.0**60).astype(np.uint64)
+        draws = [
+            ((bits >> np.uint64(12 * k)) & np.uint64(0xFFF)) / 4096.0 for k in range(5)
+        ]
+        opens = prev_closes * (1 + vol / 4 * (draws[0] - 0.5))
+        highs = np.maximum(opens, closes) * (1 + vol / 2 * draws[1])
+        lows = np.minimum(opens, closes) * (1 - vol / 2 * draws[2])
+        volumes = (base_volume * (0.5 + draws[3])).astype(np.int64)
+
+        prices = [np.round(x, 4).tolist() for x in (opens, highs, lows, closes)]
+        candles = [
+            {
+                "open": o,
+                "high": h,
+                "low": lo,
+                "close": c,
+                "volume": v,
+                "datetime": _midnight_ms(d),
+            }
+            for o, h, lo, c, v, d in zip(*prices, volumes.tolist(), ordinals.tolist())
+        ]
+        if self.nan_rate:
+            for n in np.flatnonzero(draws[4] < self.nan_rate).tolist():
+                field = NAN_FIELDS[int(draws[4][n] * 1e6) % len(NAN_FIELDS)]
+                candles[n][field] = "NaN"
+        return candles
+
+    def get_symbol_info(self, symbol):
+        delay, _, error_draw = self._draw()
+        time.sleep(delay)
+        rng = self._symbol_rng(symbol)
+        if error_draw < self.error_rate or rng.random() < self.empty_rate:
+            return None
+        sector = rng.choice(sorted(SECTORS))
+        return {
+            "symbol": symbol,
+            "shortName": f"{symbol} Stub Inc.",
+            "sector": sector,
+            "industry": rng.choice(SECTORS[sector]),
+            "quoteType": "EQUITY",
+        }
+
+    def get_earnings_dates(self, symbol):
+        """
+        Quarterly dates on a per symbol weekday, the last one announced a
+        quarter ahead, like Yahoo lists them
+        """
+        delay, _, error_draw = self._draw()
+        time.sleep(delay)
+        rng = self._symbol_rng(symbol)
+        if error_draw < self.error_rate or rng.random() < self.empty_rate:
+            return None
+        offset = rng.randrange(15, 45)
+        today = datetime.date.today()
+        ans = []
+        for year in range(today.year - EARNINGS_YEARS, today.year + 2):
+            for month in (1, 4, 7, 10):
+                day = datetime.date(year, month, 1) + datetime.timedelta(days=offset)
+                if day.weekday() > 4:
+                    # reports fall on business days, move to Monday
+                    day += datetime.timedelta(days=7 - day.weekday())
+                if day <= today + datetime.timedelta(days=92):
+                    ans.append(datetime.datetime(day.year, day.month, day.day))
+        return ans
@@ -0,0 +1,99 @@
+from secmaster.providers.base import PriceProvider
+
+
+class TDAProvider(PriceProvider):
+    """
+    Live provider: TDA for prices, Yahoo for symbol info.
+    """
+
+    name = "TDA"
+
+    def __init__(self, client=None, max_connections=8):
+        """
+        :param client: tda client, created from the token file when None
+        :param max_connections: connection pool size for async requests
+        """
+        self._client = client
+        self.max_connections = max_connections
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from secmaster.tda_client.tda_client import get_tda_client
+
+            self._client = get_tda_client()
+        return self._client
+
+    def get_price_history(self, symbol, date_from=None, date_to=None):
+        client = self.client
+        if date_from is None:
+            # Get all bars available
+            return client.get_price_history(
+                symbol,
+                period_type=client.PriceHistory.PeriodType.YEAR,
+                period=client.PriceHistory.Period.TWENTY_YEARS,
+                frequency_type=client.PriceHistory.FrequencyType.DAILY,
+                frequency=client.PriceHistory.Frequency.DAILY,
+                need_extended_hours_data=False,
+            )
+        # or get bars within a date range
+        return client.get_price_history(
+            symbol,
+            period_type=client.PriceHistory.PeriodType.YEAR,
+            start_datetime=date_from,
+            end_datetime=date_to,
+            frequency_type=client.PriceHistory.FrequencyType.DAILY,
+            frequency=client.PriceHistory.Frequency.DAILY,
+            need_extended_hours_data=False,
+        )
+
+    async def __aenter__(self):
+        from secmaster.tda_client.async_client import AsyncTDAClient
+        from secmaster.tda_client.tda_client import TOKEN_PATH
+
+        if not TOKEN_PATH.exists():
+            # first run on the machine, the login flow of get_tda_client writes it
+            _login = self.client
+        self._async_client = AsyncTDAClient(max_connections=self.max_connections)
+        await self._async_client.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._async_client.__aexit__(*exc)
+        self._async_client = None
+
+    async def aget_price_history(self, symbol, date_from=None, date_to=None):
+        if self._async_client is None:
+            return await super().aget_price_history(symbol, date_from, date_to)
+        return await self._async_client.get_price_history(symbol, date_from, date_to)
+
+    def get_symbol_info(self, symbol):
+        import yfinance as yf
+
+        ticket = yf.Ticker(symbol)
+        i = ticket.info
+
+        try:
+            _validate = i["shortName"]
+            _validate = i["symbol"]
+            return i
+        except KeyError:
+            return None
+
+    def get_earnings_dates(self, symbol, limit=12):
+        """
+        :param limit: most recent dates asked to Yahoo, announced ones included
+        """
+        import yfinance as yf
+
+        try:
+            frame = yf.Ticker(symbol).get_earnings_dates(limit=limit)
+        except (KeyError, ValueError, IndexError):
+            # yfinance fails this way on symbols without an earnings page
+            return None
+        if frame is None or frame.empty:
+            return None
+        # stamped with the announcement time in New York, only the day matters
+        days = frame.index.tz_localize(None).normalize().unique()
+        return sorted(x.to_pydatetime() for x in days)
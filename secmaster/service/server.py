@@ -0,0 +1,376 @@
+"""
+Read-only HTTP service over the bar store.
+
+One process holds the database connection pool and the warm bar cache for every
+consumer. Responses are columnar and streamed in batches, as an Arrow IPC
+stream when pyarrow is installed, otherwise as one JSON object of columns per
+line. Both are gzip compressed when the client accepts it, flushed after
+every batch so the client can start on the first one.
+
+The bar cache follows the bar writers of every process: a background thread
+reads bar_changes every poll interval and drops the ranges written.
+
+    GET /bars?symbol=AAPL,MSFT&from=2020-01-01&to=2020-12-31
+    GET /snapshot                    latest bar of every symbol
+    GET /snapshot?date=2022-04-22    every symbol's bar on a session date
+    GET /universe?active=1           symbols, optionally only to_update ones
+    GET /changes?after=1200          bar change feed after a seq
+
+    python -m secmaster.service.server --port 8050
+"""
+import argparse
+import datetime
+import json
+import logging
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import and_, select
+
+from secmaster.common.tools import DatabaseConnector
+from secmaster.db.bar_cache import BAR_FIELDS, get_bar_cache, iter_bars
+from secmaster.db.change_feed import read_changes
+from secmaster.db.models import Bar, LatestBar, Symbol
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BATCH_ROWS = 50000
+# seconds between reads of bar_changes
+POLL_INTERVAL = 1.0
+ARROW_TYPE = "application/vnd.apache.arrow.stream"
+JSON_TYPE = "application/x-ndjson"
+SNAPSHOT_FIELDS = ["symbol"] + BAR_FIELDS
+UNIVERSE_FIELDS = ["symbol", "name", "sector", "industry", "quote_type"]
+CHANGES_FIELDS = ["seq", "run_id", "symbol", "date_from", "date_to", "n_rows"]
+
+
+def _arrow():
+    try:
+        import pyarrow
+
+        return pyarrow
+    except ImportError:
+        return None
+
+
+def _param(params, name, default=None):
+    values = params.get(name)
+    return values[0] if values else default
+
+
+def _date_param(params, name):
+    value = _param(params, name)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO date, got {value}")
+
+
+def _batches(columns, rows, size=BATCH_ROWS):
+    """
+    Row tuples to column dicts of at most size rows
+    """
+    for i in range(0, len(rows), size):
+        chunk = rows[i : i + size]
+        yield {name: [x[n] for x in chunk] for n, name in enumerate(columns)}
+
+
+def get_bars(server, params):
+    symbols = _param(params, "symbol")
+    if not symbols:
+        raise ValueError("symbol is required")
+    date_from = _date_param(params, "from")
+    date_to = _date_param(params, "to")
+
+    s = server.connector.session()
+    try:
+        for symbol in symbols.split(","):
+            # streamed on a cache miss, a long range is never all in memory
+            rows = iter_bars(
+                s, symbol, date_from, date_to, server.cache, batch_rows=BATCH_ROWS
+            )
+            for each in rows:
+                for batch in _batches(BAR_FIELDS, each):
+                    yield dict(symbol=[symbol] * len(batch["date"]), **batch)
+    finally:
+        s.close()
+
+
+def get_snapshot(server, params):
+    date = _date_param(params, "date")
+    if date is None:
+        stmt = select(Symbol.symbol, *[getattr(LatestBar, x) for x in BAR_FIELDS])
+        stmt = stmt.join(Symbol, Symbol.id == LatestBar.symbol_id)
+    else:
+        # bars not yet moved by db/normalize_bar_dates.py carry an hour, whole day
+        start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        on = and_(
+            Bar.symbol_id == Symbol.id,
+            Bar.date >= start,
+            Bar.date < start + datetime.timedelta(days=1),
+        )
+        # symbols first, each one a seek on (symbol_id, date), bars has no index
+        # on date alone
+        stmt = (
+            select(Symbol.symbol, *[getattr(Bar, x) for x in BAR_FIELDS])
+            .select_from(Symbol)
+            .join(Bar, on)
+            .prefix_with("STRAIGHT_JOIN", dialect="mysql")
+        )
+
+    s = server.connector.session()
+    try:
+        rows = s.execute(stmt.order_by(Symbol.symbol)).all()
+    finally:
+        s.close()
+    yield from _batches(SNAPSHOT_FIELDS, rows)
+
+
+def get_universe(server, params):
+    stmt = select(*[getattr(Symbol, x) for x in UNIVERSE_FIELDS])
+    if _param(params, "active") == "1":
+        stmt = stmt.where(Symbol.to_update == True)
+
+    s = server.connector.session()
+    try:
+        rows = s.execute(stmt.order_by(Symbol.symbol)).all()
+    finally:
+        s.close()
+    yield from _batches(UNIVERSE_FIELDS, rows)
+
+
+def get_changes(server, params):
+    try:
+        after = int(_param(params, "after", 0))
+        limit = int(_param(params, "limit", BATCH_ROWS))
+    except ValueError:
+        raise ValueError("after and limit must be integers")
+
+    s = server.connector.session()
+    try:
+        changes = read_changes(s, after, limit)
+    finally:
+        s.close()
+    rows = [tuple(x[k] for k in CHANGES_FIELDS) for x in changes]
+    yield from _batches(CHANGES_FIELDS, rows)
+
+
+# path -> (handler, columns of its batches)
+ROUTES = {
+    "/bars": (get_bars, SNAPSHOT_FIELDS),
+    "/snapshot": (get_snapshot, SNAPSHOT_FIELDS),
+    "/universe": (get_universe, UNIVERSE_FIELDS),
+    "/changes": (get_changes, CHANGES_FIELDS),
+}
+
+
+class ChunkedWriter:
+    """
+    File-like object writing HTTP/1.1 chunks, gzip compressed if asked
+    """
+
+    def __init__(self, wfile, compress=False):
+        self.wfile = wfile
+        self.closed = False
+        self.aborted = False
+        # wbits 31 is the gzip container
+        self._gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def _chunk(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def write(self, data):
+        data = bytes(data)
+        if self._gzip is not None:
+            self._chunk(self._gzip.compress(data))
+        else:
+            self._chunk(data)
+        return len(data)
+
+    def flush(self):
+        """
+        Send everything written so far, the compressor keeps nothing back
+        """
+        if self._gzip is not None:
+            self._chunk(self._gzip.flush(zlib.Z_SYNC_FLUSH))
+        self.wfile.flush()
+
+    def abort(self):
+        """
+        End without the last chunk, so the client sees a truncated response
+        instead of a complete one
+        """
+        self.aborted = True
+        self.closed = True
+
+    def close(self):
+        if self.closed:
+            return
+        if self._gzip is not None:
+            self._chunk(self._gzip.flush())
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        self.closed = True
+
+
+class PriceQueryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        route, columns = ROUTES.get(url.path, (None, None))
+        if route is None:
+            return self._error(404, f"unknown path {url.path}")
+        params = parse_qs(url.query)
+
+        try:
+            batches = route(self.server, params)
+            # run the generator up to the first batch so bad requests fail here
+            first = next(batches, None)
+        except ValueError as e:
+            return self._error(400, str(e))
+        except SystemExit:
+            # the connector logged why the database is not reachable
+            return self._error(503, "database unavailable")
+        except Exception as e:
+            logger.exception(f"{self.path} failed")
+            return self._error(500, f"{type(e).__name__}: {e}")
+
+        pa = _arrow()
+        use_arrow = pa is not None and _param(params, "format", "arrow") == "arrow"
+        compress = "gzip" in self.headers.get("Accept-Encoding", "")
+
+        self.send_response(200)
+        self.send_header("Content-Type", ARROW_TYPE if use_arrow else JSON_TYPE)
+        self.send_header("Transfer-Encoding", "chunked")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.end_headers()
+
+        out = ChunkedWriter(self.wfile, compress)
+        try:
+            if use_arrow:
+                self._write_arrow(pa, out, columns, first, batches)
+            else:
+                self._write_json(out, first, batches)
+        except (Exception, SystemExit):
+            # the status is sent, all that is left is to cut the stream short
+            logger.exception(f"{self.path} failed while streaming")
+            out.abort()
+            self.close_connection = True
+        finally:
+            out.close()
+
+    def _write_arrow(self, pa, out, columns, first, batches):
+        if first is None:
+            # no rows, still a valid stream: the schema and no batch
+            schema = pa.schema([(x, pa.string()) for x in columns])
+            with pa.ipc.new_stream(out, schema):
+                pass
+            return
+        batch = pa.RecordBatch.from_pydict(first)
+        # a column all None in the first batch is text missing everywhere so far
+        schema = pa.schema(
+            [
+                f.with_type(pa.string()) if pa.types.is_null(f.type) else f
+                for f in batch.schema
+            ]
+        )
+        batch = batch.cast(schema)
+        with pa.ipc.new_stream(out, batch.schema) as writer:
+            writer.write_batch(batch)
+            out.flush()
+            for each in batches:
+                each = pa.RecordBatch.from_pydict(each, schema=batch.schema)
+                writer.write_batch(each)
+                out.flush()
+
+    def _write_json(self, out, first, batches):
+        if first is None:
+            return
+        out.write(json.dumps(first, default=str).encode() + b"\n")
+        out.flush()
+        for each in batches:
+            out.write(json.dumps(each, default=str).encode() + b"\n")
+            out.flush()
+
+    def _error(self, status, message):
+        body = json.dumps({"error": message}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class PriceQueryServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server sharing one connection pool and one bar cache, kept
+    in step with bar_changes by a background thread
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, pool_size=8, cache=None, poll_interval=POLL_INTERVAL):
+        """
+        :param address: (host, port)
+        :param pool_size: database connections kept open
+        :param cache: BarCache, default the process wide one
+        :param poll_interval: seconds between reads of bar_changes
+        """
+        super().__init__(address, PriceQueryHandler)
+        self.connector = DatabaseConnector(pool_size=pool_size)
+        self.cache = cache or get_bar_cache()
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._watcher = threading.Thread(target=self._watch_changes, daemon=True)
+        self._watcher.start()
+
+    def _watch_changes(self):
+        failing = False
+        while not self._stop.wait(self.poll_interval):
+            try:
+                s = self.connector.session()
+                try:
+                    self.cache.sync(s, force=True)
+                finally:
+                    s.close()
+            except (Exception, SystemExit):
+                # keep polling, the database may come back; log once per outage
+                if not failing:
+                    logger.exception("Can not read bar_changes, bar cache not synced")
+                failing = True
+                continue
+            if failing:
+                logger.info("Reading bar_changes again")
+            failing = False
+
+    def server_close(self):
+        self._stop.set()
+        self._watcher.join()
+        super().server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="secmaster read-only price service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--pool-size", type=int, default=8)
+    args = parser.parse_args()
+
+    server = PriceQueryServer((args.host, args.port), pool_size=args.pool_size)
+    logger.info(f"Serving prices on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
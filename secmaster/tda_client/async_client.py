@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+
+from secmaster.tda_client.tda_client import API_KEY, TOKEN_PATH
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TDA_API = "https://api.tdameritrade.com/v1"
+TOKEN_URL = f"{TDA_API}/oauth2/token"
+# refresh a bit before the access token actually expires
+TOKEN_REFRESH_MARGIN = 60
+
+
+def http2_available():
+    """
+    httpx only speaks HTTP/2 when the optional h2 package is installed
+    """
+    try:
+        import h2  # noqa: F401
+
+        return True
+    except ImportError:
+        return False
+
+
+class TokenManager:
+    """
+    Access token shared by every coroutine of an AsyncTDAClient.
+
+    The token file is the one written by tda-api, so both clients can be used
+    with the same login. Refreshing happens once, behind a lock, however many
+    requests notice the expiry at the same time.
+    """
+
+    def __init__(self, token_path=TOKEN_PATH, api_key=API_KEY):
+        self.token_path = token_path
+        self.api_key = api_key
+        self._lock = asyncio.Lock()
+        with open(token_path) as f:
+            self._stored = json.load(f)
+
+    @property
+    def token(self):
+        return self._stored["token"]
+
+    @property
+    def client_id(self):
+        # same convention as tda-api
+        if self.api_key.endswith("@AMER.OAUTHAP"):
+            return self.api_key
+        return f"{self.api_key}@AMER.OAUTHAP"
+
+    def _expired(self):
+        return self.token.get("expires_at", 0) - TOKEN_REFRESH_MARGIN < time.time()
+
+    async def access_token(self, http, force_refresh=False):
+        """
+        :param http: httpx.AsyncClient used for the refresh request
+        :param force_refresh: refresh even if the token looks valid (after a 401)
+        :return: access token str
+        """
+        stale = self.token["access_token"]
+        if force_refresh or self._expired():
+            async with self._lock:
+                # another coroutine may have refreshed while we waited
+                if self.token["access_token"] == stale and (
+                    force_refresh or self._expired()
+                ):
+                    await self._refresh(http)
+        return self.token["access_token"]
+
+    async def _refresh(self, http):
+        logger.info("Refreshing TDA access token")
+        r = await http.post(
+            TOKEN_URL,
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": self.token["refresh_token"],
+                "client_id": self.client_id,
+            },
+        )
+        r.raise_for_status()
+        new_token = r.json()
+        new_token.setdefault("refresh_token", self.token["refresh_token"])
+        new_token["expires_at"] = int(time.time()) + int(new_token.get("expires_in", 1800))
+        self._stored["token"] = new_token
+        with open(self.token_path, "w") as f:
+            json.dump(self._stored, f)
+
+
+class AsyncTDAClient:
+    """
+    Price history over one pooled httpx.AsyncClient.
+
+    All requests share keep-alive connections (HTTP/2 when h2 is installed), so
+    thousands of symbols multiplex over a few connections.
+
+        async with AsyncTDAClient() as client:
+            r = await client.get_price_history("AAPL")
+    """
+
+    def __init__(self, max_connections=8, timeout=30.0, token_manager=None):
+        """
+        :param max_connections: connections kept open to the TDA API
+        :param timeout: seconds per request
+        :param token_manager: TokenManager, read from the token file when None
+        """
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.tokens = token_manager or TokenManager()
+        self.http = None
+
+    async def __aenter__(self):
+        self.http = httpx.AsyncClient(
+            base_url=TDA_API,
+            http2=http2_available(),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+            timeout=self.timeout,
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.http.aclose()
+        self.http = None
+
+    async def get_price_history(self, symbol, date_from=None, date_to=None):
+        """
+        Daily candles, same query as TDAProvider.get_price_history
+
+        :param symbol: symbol str
+        :param date_from: aware datetime or None for twenty years
+        :param date_to: aware datetime
+        :return: httpx.Response
+        """
+        params = {
+            "periodType": "year",
+            "frequencyType": "daily",
+            "frequency": 1,
+            "needExtendedHoursData": "false",
+        }
+        if date_from is None:
+            params["period"] = 20
+        else:
+            params["startDate"] = _epoch_ms(date_from)
+            if date_to is not None:
+                params["endDate"] = _epoch_ms(date_to)
+
+        url = f"/marketdata/{symbol}/pricehistory"
+        token = await self.tokens.access_token(self.http)
+        r = await self.http.get(url, params=params, headers=_auth(token))
+        if r.status_code == 401:
+            # expired early or revoked, refresh once and retry
+            token = await self.tokens.access_token(self.http, force_refresh=True)
+            r = await self.http.get(url, params=params, headers=_auth(token))
+        return r
+
+
+def _epoch_ms(d):
+    if d.tzinfo is None:
+        # timestamp() would read it in the host timezone
+        raise ValueError(f"naive datetime {d}, use validation.exchange_window")
+    return int(d.timestamp() * 1000)
+
+
+def _auth(token):
+    return {"Authorization": f"Bearer {token}"}
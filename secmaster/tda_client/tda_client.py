@@ -2,7 +2,6 @@ import json
 from pathlib import Path
 from pprint import pprint
 
-from httpx import main
 from secmaster.common.config import Config
 from secmaster.common.tools import get_project_root
 from tda import auth